@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+"""
+Latency and ratio of compressed frames for typical shell outputs, and the
+time estimated over a slow link.
+
+Usage: python benchmarks/bench_compress.py [link_kb_per_second]
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import zlib
+import socket
+import threading
+# run from a checkout without installing pylane
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from pylane.shell.sock import Transport
+from pylane.shell import help_functions, values
+
+if sys.version_info[0] == 3:
+    from io import StringIO
+else:
+    from io import BytesIO as StringIO
+
+
+LEVELS = [0, 1, 3, 6, 9]
+ROUNDS = 20
+# a bastion tunnel
+LINK_SPEED = 1024
+
+
+class Item(object):
+
+    def __init__(self, i):
+        self.id = i
+        self.name = 'item-%d' % i
+
+
+def thread_stacks():
+    """print_threads output of 16 busy threads"""
+    stop = threading.Event()
+
+    def nested(depth):
+        if depth:
+            return nested(depth - 1)
+        stop.wait()
+
+    threads = [threading.Thread(target=nested, args=(20,)) for _ in range(16)]
+    for thread in threads:
+        thread.start()
+    stdout, sys.stdout = sys.stdout, StringIO()
+    try:
+        help_functions.print_threads()
+        return sys.stdout.getvalue()
+    finally:
+        sys.stdout = stdout
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+
+def payloads():
+    items = [Item(i) for i in range(5000)]
+    table = dict(('key-%d' % i, (i, i * 0.5, 'value-%d' % i))
+                 for i in range(20000))
+    return [
+        ('print_threads', thread_stacks().encode('utf-8')),
+        ('get_insts repr', repr(items).encode('utf-8')),
+        ('dict repr', repr(table).encode('utf-8')),
+        ('dict value', values.dumps(table, values.HandleTable(), True)),
+    ]
+
+
+def bench(sender, receiver, data, level):
+    """
+    Returns:
+        tuple: (seconds from send to received, bytes on wire) of a frame
+    """
+    sender.compress_level = level
+
+    def send():
+        for _ in range(ROUNDS):
+            sender.send_bytes(data)
+
+    thread = threading.Thread(target=send)
+    start = time.time()
+    thread.start()
+    for _ in range(ROUNDS):
+        receiver.recv_frame()
+    latency = (time.time() - start) / ROUNDS
+    thread.join()
+    wire = len(data)
+    if level:
+        wire = min(wire, len(zlib.compress(data, level)))
+    return latency, wire
+
+
+def main():
+    link_speed = int(sys.argv[1]) if len(sys.argv) > 1 else LINK_SPEED
+    left, right = socket.socketpair()
+    sender, receiver = Transport(left), Transport(right)
+    print('%-16s %-6s %-10s %-8s %-12s %s' % (
+        'PAYLOAD', 'LEVEL', 'SIZE', 'RATIO', 'LATENCY ms',
+        'AT %dKB/s ms' % link_speed))
+    try:
+        for name, data in payloads():
+            for level in LEVELS:
+                latency, wire = bench(sender, receiver, data, level)
+                print('%-16s %-6s %-10s %-8.2f %-12.2f %.1f' % (
+                    name, level, len(data), float(len(data)) / wire,
+                    latency * 1e3,
+                    (latency + wire / 1024.0 / link_speed) * 1e3))
+    finally:
+        sender.close()
+        receiver.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+"""
+Import time of each pylane subcommand by python -X importtime, fails if a
+subcommand imports a module it does not need.
+
+Subcommands run against a pid which does not exist, they import all they
+use before failing.
+
+Usage: python benchmarks/bench_import.py
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import tempfile
+import subprocess
+
+
+# pylane is run from this checkout, installed or not
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# never exists, larger than pid_max
+NO_PID = '99999999'
+
+# modules a subcommand must not import
+HEAVY_MODULES = ['IPython', 'multiprocessing']
+
+
+def commands(code_file):
+    return [
+        ('inject', ['inject', NO_PID, code_file], HEAVY_MODULES),
+        ('exec', ['exec', NO_PID, '1'], HEAVY_MODULES),
+        ('ps', ['ps'], HEAVY_MODULES),
+        ('agent list', ['agent', 'list'], HEAVY_MODULES),
+        ('shell', ['shell', NO_PID], ['multiprocessing']),
+    ]
+
+
+def import_times(args):
+    """
+    Returns:
+        dict: {module: cumulative us} of modules imported by args
+    """
+    process = subprocess.Popen(
+        [sys.executable, '-X', 'importtime', '-m', 'pylane.entry'] + args,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=ROOT)
+    _, err = process.communicate()
+    times = {}
+    for line in err.decode('utf-8', 'replace').splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = (int(cumulative), len(name) - len(name.lstrip()))
+    return times
+
+
+def main():
+    if sys.version_info < (3, 7):
+        print('python -X importtime needs python 3.7+')
+        exit(1)
+    fd, code_file = tempfile.mkstemp(suffix='.py')
+    os.close(fd)
+    failed = False
+    print('%-12s %-10s %-8s %s' % ('COMMAND', 'IMPORT ms', 'MODULES', 'HEAVY'))
+    try:
+        for name, args, forbidden in commands(code_file):
+            times = import_times(args)
+            # modules imported at top level, not by another module
+            top = [cumulative for cumulative, indent in times.values()
+                   if indent == 1]
+            heavy = [module for module in forbidden if module in times]
+            failed = failed or bool(heavy)
+            print('%-12s %-10.1f %-8s %s' % (
+                name, sum(top) / 1e3, len(times), ','.join(heavy) or '-'))
+    finally:
+        os.remove(code_file)
+    exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
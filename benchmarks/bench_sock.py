@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+"""
+Throughput of pylane socket transport frames over loopback.
+
+Usage: python benchmarks/bench_sock.py [max_size_mb]
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import threading
+# run from a checkout without installing pylane
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from pylane.shell.sock import SockServer, SockClient
+
+
+SIZES = [
+    1 << 10,
+    16 << 10,
+    256 << 10,
+    1 << 20,
+    10 << 20,
+    100 << 20,
+]
+# bytes sent for each size, at least 3 frames
+TOTAL = 200 << 20
+
+
+def connect():
+    server = SockServer(listen_timeout=5)
+    server.listen()
+    client = SockClient(server.host, server.port)
+    thread = threading.Thread(target=server.accept)
+    thread.start()
+    client.connect()
+    thread.join()
+    return server, client
+
+
+def bench(server, client, size):
+    count = max(3, TOTAL // size)
+    payload = b'x' * size
+
+    def send():
+        for _ in range(count):
+            client.send_bytes(payload)
+
+    thread = threading.Thread(target=send)
+    start = time.time()
+    thread.start()
+    for _ in range(count):
+        assert len(server.recv_frame()) == size
+    duration = time.time() - start
+    thread.join()
+    return count, duration
+
+
+def human(size):
+    for unit in ('B', 'KB', 'MB'):
+        if size < 1024:
+            return '%d%s' % (size, unit)
+        size //= 1024
+    return '%dGB' % size
+
+
+def main():
+    max_size = int(sys.argv[1]) << 20 if len(sys.argv) > 1 else SIZES[-1]
+    server, client = connect()
+    print('%-8s %-8s %-10s %s' % ('FRAME', 'FRAMES', 'MB/s', 'us/frame'))
+    try:
+        for size in SIZES:
+            if size > max_size:
+                break
+            count, duration = bench(server, client, size)
+            print('%-8s %-8s %-10.1f %.1f' % (
+                human(size), count,
+                count * size / duration / (1 << 20),
+                duration / count * 1e6))
+    finally:
+        client.close()
+        server.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+"""
+Place code where target can read it. Inline in injected code if the engine
+writes target memory directly, otherwise a file in our /tmp if target
+shares our mount namespace, in target's /tmp by /proc/PID/root, or a memfd
+of ours opened by target through /proc.
+"""
+
+import os
+import tempfile
+from . import procfs
+
+
+def process_id(pid, key):
+    """real uid or gid of pid by key Uid or Gid"""
+    status = procfs.read_file('/proc/%d/status' % pid) or ''
+    for line in status.splitlines():
+        if line.startswith(key + ':'):
+            return int(line.split()[1])
+    return None
+
+
+def process_uid(pid):
+    return process_id(pid, 'Uid')
+
+
+def process_gid(pid):
+    return process_id(pid, 'Gid')
+
+
+def same_namespace(pid, name):
+    ns = procfs.readlink('/proc/%d/ns/%s' % (pid, name))
+    return ns is not None and ns == procfs.readlink('/proc/self/ns/%s' % name)
+
+
+class Delivery(object):
+    """Deliver data of code files to a target, remove them on cleanup."""
+
+    METHODS = ('host', 'root', 'memfd')
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.namespace = procfs.available() and procfs.namespace(pid)
+        self.method = self.choose_method()
+        # files in our view and memfds to remove
+        self.files = []
+        self.memfds = []
+
+    def choose_method(self):
+        """
+        Returns:
+            str: method in METHODS to place files
+        """
+        if not self.namespace:
+            return 'host'
+        if os.access('/proc/%d/root/tmp' % self.pid, os.W_OK):
+            return 'root'
+        # target opens our fd by our pid, needs same pid namespace and
+        # perm to read our /proc
+        if hasattr(os, 'memfd_create') and same_namespace(self.pid, 'pid') \
+                and process_uid(self.pid) in (0, os.getuid()):
+            return 'memfd'
+        return 'host'
+
+    def reserve(self, suffix=''):
+        """
+        create an empty file target can read and remove
+        Returns:
+            tuple: (fd, path of ours, path of target)
+        """
+        root_tmp = '/proc/%d/root/tmp' % self.pid
+        if self.method == 'root':
+            (fd, path) = tempfile.mkstemp(suffix=suffix, dir=root_tmp)
+            target = '/tmp/' + os.path.basename(path)
+        else:
+            (fd, path) = tempfile.mkstemp(suffix=suffix)
+            target = path
+        # target may run as another user, it must own the file to remove
+        # it from sticky /tmp
+        os.chmod(path, 0o644)
+        uid = process_uid(self.pid)
+        if uid is not None and uid != os.getuid():
+            try:
+                os.chown(path, uid, process_gid(self.pid))
+            except OSError:
+                pass
+        self.files.append(path)
+        return fd, path, target
+
+    def place_file(self, data, suffix=''):
+        """
+        Returns:
+            str: path of data for target
+        """
+        if self.method == 'memfd':
+            fd = os.memfd_create('pylane')
+            self.memfds.append(fd)
+            path = '/proc/%d/fd/%d' % (os.getpid(), fd)
+        else:
+            fd, _, path = self.reserve(suffix)
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+        if self.method != 'memfd':
+            os.close(fd)
+        return path
+
+    def read_code(self, data, inline=False):
+        """
+        Returns:
+            str: python expression evaluated in target to bytes of data
+        """
+        if inline:
+            # b prefix for data of py2 str
+            return ('b' if bytes is str else '') + repr(data)
+        return '_pylane_read("%s")' % self.place_file(data)
+
+    def target_paths(self, paths):
+        """paths which target sees as the same files as ours"""
+        if not self.namespace:
+            return list(paths)
+        visible = []
+        for path in paths:
+            root_path = '/proc/%d/root%s' % (self.pid, path)
+            try:
+                if os.path.samefile(path, root_path):
+                    visible.append(path)
+            except OSError:
+                continue
+        return visible
+
+    def forget(self):
+        """leave placed files to target"""
+        self.files = []
+
+    def cleanup(self):
+        for path in self.files:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        for fd in self.memfds:
+            os.close(fd)
+        self.files = []
+        self.memfds = []
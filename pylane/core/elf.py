@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+
+"""
+Minimal ELF reader, find symbols of python binary or libpython.
+"""
+
+import os
+import re
+import mmap
+import struct
+import binascii
+from .exception import RequirementsInvalid
+
+
+ELF_MAGIC = b'\x7fELF'
+ELFCLASS64 = 2
+ELFDATA2LSB = 1
+ET_EXEC = 2
+ET_DYN = 3
+PT_LOAD = 1
+PT_NOTE = 4
+NT_GNU_BUILD_ID = 3
+SHT_SYMTAB = 2
+SHT_DYNSYM = 11
+SHN_UNDEF = 0
+
+
+class ElfFile(object):
+    """Parse headers of an ELF file, lookup its symbols."""
+
+    def __init__(self, path):
+        """Init by file path.
+        Args:
+            path (str): ELF file path.
+        """
+        self.path = path
+        # map the file, only pages of headers and symbols are read
+        with open(path, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.parse_header()
+        self._symbols = None
+        self._sizes = None
+
+    def close(self):
+        self.data.close()
+
+    def parse_header(self):
+        data = self.data
+        if data[:4] != ELF_MAGIC:
+            raise RequirementsInvalid('%s is not an ELF file.' % self.path)
+        self.is_64 = ord(data[4:5]) == ELFCLASS64
+        endian = '<' if ord(data[5:6]) == ELFDATA2LSB else '>'
+        self.endian = endian
+        if self.is_64:
+            (self.type, self.machine, _, _, phoff, shoff, _,
+             _, phentsize, phnum, shentsize, shnum, _) = struct.unpack_from(
+                 endian + 'HHIQQQIHHHHHH', data, 16)
+        else:
+            (self.type, self.machine, _, _, phoff, shoff, _,
+             _, phentsize, phnum, shentsize, shnum, _) = struct.unpack_from(
+                 endian + 'HHIIIIIHHHHHH', data, 16)
+
+        self.segments = []
+        for i in range(phnum):
+            offset = phoff + i * phentsize
+            if self.is_64:
+                (p_type, _, p_offset, p_vaddr, _, p_filesz, _, _) = \
+                    struct.unpack_from(endian + 'IIQQQQQQ', data, offset)
+            else:
+                (p_type, p_offset, p_vaddr, _, p_filesz, _, _, _) = \
+                    struct.unpack_from(endian + 'IIIIIIII', data, offset)
+            self.segments.append((p_type, p_offset, p_vaddr, p_filesz))
+
+        self.sections = []
+        for i in range(shnum):
+            offset = shoff + i * shentsize
+            if self.is_64:
+                (_, sh_type, _, _, sh_offset, sh_size, sh_link, _, _,
+                 sh_entsize) = struct.unpack_from(
+                     endian + 'IIQQQQIIQQ', data, offset)
+            else:
+                (_, sh_type, _, _, sh_offset, sh_size, sh_link, _, _,
+                 sh_entsize) = struct.unpack_from(
+                     endian + 'IIIIIIIIII', data, offset)
+            self.sections.append(
+                (sh_type, sh_offset, sh_size, sh_link, sh_entsize))
+
+    @property
+    def load_vaddr(self):
+        """page aligned vaddr of the first load segment, mapped at offset 0"""
+        vaddrs = [s[2] for s in self.segments if s[0] == PT_LOAD]
+        return (min(vaddrs) & ~0xfff) if vaddrs else 0
+
+    @property
+    def symbols(self):
+        """defined symbols {name: value} of .dynsym and .symtab"""
+        if self._symbols is None:
+            self._symbols, self._sizes = self.parse_symbols()
+        return self._symbols
+
+    @property
+    def sizes(self):
+        """sizes {name: size} of defined symbols"""
+        if self._sizes is None:
+            self._symbols, self._sizes = self.parse_symbols()
+        return self._sizes
+
+    def parse_symbols(self):
+        data = self.data
+        endian = self.endian
+        symbols = {}
+        sizes = {}
+        for (sh_type, sh_offset, sh_size, sh_link, sh_entsize) in self.sections:
+            if sh_type not in (SHT_SYMTAB, SHT_DYNSYM) or not sh_entsize:
+                continue
+            str_offset = self.sections[sh_link][1]
+            for offset in range(sh_offset, sh_offset + sh_size, sh_entsize):
+                if self.is_64:
+                    (st_name, _, _, st_shndx, st_value, st_size) = \
+                        struct.unpack_from(endian + 'IBBHQQ', data, offset)
+                else:
+                    (st_name, st_value, st_size, _, _, st_shndx) = \
+                        struct.unpack_from(endian + 'IIIBBH', data, offset)
+                if st_shndx == SHN_UNDEF or not st_name or not st_value:
+                    continue
+                start = str_offset + st_name
+                name = data[start:data.find(b'\0', start)]
+                name = name.decode('utf-8', 'replace')
+                symbols[name] = st_value
+                sizes[name] = st_size
+        return symbols, sizes
+
+    def lookup(self, names):
+        """lookup symbol values
+        Args:
+            names (list): symbol names.
+        Returns:
+            dict: {name: value}, or None if any symbol not found.
+        """
+        symbols = self.symbols
+        if not all(name in symbols for name in names):
+            return None
+        return dict((name, symbols[name]) for name in names)
+
+    def read(self, vaddr, size):
+        """read file data of a vaddr in load segments"""
+        for (p_type, p_offset, p_vaddr, p_filesz) in self.segments:
+            if p_type == PT_LOAD and p_vaddr <= vaddr < p_vaddr + p_filesz:
+                offset = p_offset + vaddr - p_vaddr
+                return self.data[offset:offset + size]
+        return None
+
+    @property
+    def build_id(self):
+        """hex string of GNU build id, or None"""
+        data = self.data
+        for (p_type, p_offset, _, p_filesz) in self.segments:
+            if p_type != PT_NOTE:
+                continue
+            offset = p_offset
+            while offset + 12 <= p_offset + p_filesz:
+                namesz, descsz, note_type = struct.unpack_from(
+                    self.endian + 'III', data, offset)
+                name_offset = offset + 12
+                desc_offset = name_offset + ((namesz + 3) & ~3)
+                if note_type == NT_GNU_BUILD_ID and \
+                        data[name_offset:name_offset + namesz] == b'GNU\0':
+                    desc = data[desc_offset:desc_offset + descsz]
+                    return binascii.hexlify(desc).decode('ascii')
+                offset = desc_offset + ((descsz + 3) & ~3)
+        return None
+
+    def python_version(self):
+        """python version tuple (major, minor) of a python binary or lib"""
+        # Py_Version is exported since python 3.11
+        value = self.symbols.get('Py_Version')
+        data = value and self.read(value, 4)
+        if data and len(data) == 4:
+            hex_version = struct.unpack(self.endian + 'I', data)[0]
+            return (hex_version >> 24, (hex_version >> 16) & 0xff)
+        match = re.search(r'python(\d)\.?(\d+)', os.path.basename(self.path))
+        if match:
+            return (int(match.group(1)), int(match.group(2)))
+        return None
@@ -12,6 +12,10 @@ class RequirementsInvalid(PylaneException):
     pass
 
 
+class InjectFailed(PylaneException):
+    pass
+
+
 def PylaneExceptionHandler(func):
     def wrapper(*args, **kwargs):
         try:
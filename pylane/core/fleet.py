@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+
+"""
+Inject many python processes in parallel.
+"""
+
+import os
+import re
+import time
+from . import procfs
+from .injector import Injector
+from .exception import (
+    PylaneException,
+    RequirementsInvalid,
+    PylaneExceptionHandler
+)
+
+try:
+    # py3
+    from subprocess import getoutput
+except ImportError:
+    # py2
+    from commands import getoutput
+
+
+def list_processes():
+    """
+    Returns:
+        list: [(pid, ppid, command)] of all processes
+    """
+    if procfs.available():
+        return procfs.list_processes()
+    processes = []
+    for line in getoutput('ps ax -o pid=,ppid=,command=').splitlines():
+        parts = line.split(None, 2)
+        if len(parts) < 2 or not parts[0].isdigit():
+            continue
+        processes.append(
+            (int(parts[0]), int(parts[1]), parts[2] if len(parts) > 2 else ''))
+    return processes
+
+
+def expand_targets(target, children=False, match=False):
+    """Expand target arg to pids.
+    Args:
+        target (str): pids split by comma, or a cmdline regex if match.
+        children (bool): expand each pid to its child processes.
+        match (bool): target is a regex to search process cmdline.
+    Returns:
+        list: sorted pids
+    """
+    processes = list_processes() if (children or match) else []
+    if match:
+        # never inject ourselves or the shell running us
+        parents = dict((pid, ppid) for pid, ppid, _ in processes)
+        excludes = set()
+        pid = os.getpid()
+        while pid and pid not in excludes:
+            excludes.add(pid)
+            pid = parents.get(pid)
+        pattern = re.compile(target)
+        pids = set(
+            pid for pid, _, command in processes
+            if pid not in excludes and pattern.search(command)
+        )
+    else:
+        try:
+            pids = set(int(pid) for pid in target.split(',') if pid.strip())
+        except ValueError:
+            raise RequirementsInvalid('Invalid pids %s.' % target)
+    if children:
+        pids = set(
+            pid for pid, ppid, _ in processes if ppid in pids
+        )
+    if not pids:
+        raise RequirementsInvalid('No process found by %s.' % target)
+    return sorted(pids)
+
+
+class FleetInjector(object):
+    """Inject pids by a bounded thread pool, collect result of each pid."""
+
+    def __init__(self, pids, file_paths, jobs=8, timeout=10, **inject_args):
+        """
+        Args:
+            pids (list): target pids.
+            file_paths (list): code files run in each target.
+            jobs (int): max injections run at the same time.
+            timeout (int): timeout seconds of each target.
+            inject_args (dict): args of Injector.
+        """
+        self.pids = pids
+        self.file_paths = file_paths
+        self.jobs = jobs
+        self.timeout = timeout
+        self.inject_args = inject_args
+
+    def batched(self, injector):
+        """if files are run in one batch of a gdb session, which needs gdb
+        as engine, or auto engine without remote_exec in target
+        """
+        return injector.engine == 'gdb' or (
+            injector.engine == 'auto' and
+            injector.remote_exec_unavailable() is not None)
+
+    def inject_one(self, pid):
+        """
+        Returns:
+            tuple: (pid, success, latency, message), success is None if
+                script is scheduled in target but not confirmed to run
+        """
+        start = time.time()
+        try:
+            injector = Injector(pid=pid, timeout=self.timeout,
+                                **self.inject_args)
+            if len(self.file_paths) > 1 and self.batched(injector):
+                with injector.session() as session:
+                    for file_path in self.file_paths:
+                        session.queue(file_path=file_path)
+                    session.flush()
+                success = True
+            else:
+                # other engines run files one by one, as --engine says
+                for file_path in self.file_paths:
+                    injector.ensure_code_file(None, file_path)
+                    success = injector.inject()
+                    if not success:
+                        break
+                if injector.scheduled:
+                    success = None
+            message = '' if success else (
+                'scheduled, not confirmed' if success is None else 'timeout')
+        except PylaneException as e:
+            success, message = False, ' '.join(str(arg) for arg in e.args)
+        except Exception as e:
+            success, message = False, repr(e)
+        return pid, success, time.time() - start, message
+
+    def run(self):
+        """
+        Returns:
+            list: [(pid, success, latency, message)] sorted by pid
+        """
+        # multiprocessing is slow to import, only fleets need it
+        from multiprocessing.pool import ThreadPool
+        from multiprocessing import TimeoutError
+        pool = ThreadPool(min(self.jobs, len(self.pids)))
+        try:
+            pending = [
+                (pid, pool.apply_async(self.inject_one, (pid,)))
+                for pid in self.pids
+            ]
+            results = []
+            for pid, async_result in pending:
+                try:
+                    # timeout of a target is handled inside Injector,
+                    # wait a little longer before giving up here
+                    results.append(async_result.get(self.timeout * 2))
+                except TimeoutError:
+                    results.append(
+                        (pid, False, self.timeout * 2, 'no response'))
+        finally:
+            pool.terminate()
+        return sorted(results)
+
+
+def format_results(results, duration):
+    """format fleet results as a table with a summary line"""
+    lines = ['%-8s %-7s %-9s %s' % ('PID', 'STATUS', 'LATENCY', 'MESSAGE')]
+    for pid, success, latency, message in results:
+        lines.append('%-8s %-7s %-9s %s' % (
+            pid, 'ok' if success else 'pending' if success is None
+            else 'failed', '%.3fs' % latency, message))
+    succeeded = len([r for r in results if r[1]])
+    pending = len([r for r in results if r[1] is None])
+    lines.append('total %s, ok %s, pending %s, failed %s, in %.3fs' % (
+        len(results), succeeded, pending,
+        len(results) - succeeded - pending, duration))
+    return '\n'.join(lines)
+
+
+@PylaneExceptionHandler
+def get_pids(target, children=False, match=False):
+    return expand_targets(target, children, match)
+
+
+@PylaneExceptionHandler
+def inject_fleet(pids, file_paths, **kwargs):
+    """Inject pids in parallel and print a summary.
+    Returns:
+        bool: all targets succeeded
+    """
+    start = time.time()
+    results = FleetInjector(pids, file_paths, **kwargs).run()
+    print(format_results(results, time.time() - start))
+    return all(r[1] for r in results)
@@ -2,31 +2,115 @@
 
 import os
 import sys
+import errno
 import signal
 import time
 import tempfile
 import platform
 import re
 import subprocess
-import stat
 import atexit
+import itertools
 from threading import Timer
 from .exception import (
     RequirementsInvalid,
+    InjectFailed,
     PylaneExceptionHandler
 )
 
-try:
-    # py3
-    from subprocess import getoutput
-except ImportError:
-    # py2
-    from commands import getoutput
+from . import procfs
+from .delivery import Delivery
+
+
+PTRACE_REQ_MSG = ('ptrace is disabled, enable it by:'
+                  'echo 0 | sudo tee /proc/sys/kernel/yama/ptrace_scope . '
+                  'arg --privileged may be also needed for docker '
+                  'exec/run command to override ptrace_scope.')
+
+# defined in target by prepare code, reads delivered files, runs code and
+# removes injected paths after the last code file of a batch
+RUN_HELPER = '''
+def _pylane_read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+def _pylane_run(code, paths, pending, stub=None):
+    try:
+        namespace = {"__name__": "__pylane_inject__"}
+        exec(code, namespace)
+        if stub:
+            exec(stub, namespace)
+    finally:
+        pending.pop()
+        if not pending:
+            sys = __import__("sys")
+            for path in paths:
+                if path in sys.path:
+                    sys.path.remove(path)
+'''
+
+# host facts never change in a run, detect them once for all injectors,
+# None until detected, facts may be empty
+_env = None
+
+
+def detect_env():
+    """
+    Returns:
+        dict: host facts, bsd, ubuntu and ptrace_disabled
+    """
+    global _env
+    if _env is not None:
+        return _env
+    env = {}
+    if 'BSD' in platform.platform():
+        env['bsd'] = True
+
+    try:
+        with open('/etc/lsb-release', 'rb') as f:
+            lsb_release = f.read()
+        distrib = re.search(b'DISTRIB_ID=(.+)', lsb_release, re.MULTILINE).groups()[0]
+        if distrib == b'Ubuntu':
+            env['ubuntu'] = True
+    except Exception:
+        pass
+
+    # check ptrace
+    ptrace_scope = '/proc/sys/kernel/yama/ptrace_scope'
+    if os.path.exists(ptrace_scope):
+        with open(ptrace_scope, 'r') as f:
+            value = int(f.read().strip())
+        if value == 1:
+            env['ptrace_disabled'] = True
+    else:
+        getsebool = '/usr/sbin/getsebool'
+        if os.path.exists(getsebool):
+            p = subprocess.Popen(
+                [getsebool, 'deny_ptrace'],
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            out, err = p.communicate()
+            if b'deny_ptrace --> on' in out:
+                env['ptrace_disabled'] = True
+    _env = env
+    return env
+
+
+def process_exists(pid):
+    """check pid by /proc, or signal 0 where /proc is not mounted"""
+    if procfs.available():
+        return procfs.process_exists(pid)
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
 
 
 class Injector(object):
     """Inject a python process, run some code inside the vm."""
 
+    ENGINES = ('auto', 'gdb', 'ptrace', 'remote_exec')
+
     def __init__(self,
                  pid=None,
                  code=None,
@@ -34,6 +118,8 @@ class Injector(object):
                  gdb_path='gdb',
                  timeout=10,
                  verbose=0,
+                 engine='auto',
+                 stub=None,
                  **ignore):
         """Init injector by args.
         Args:
@@ -43,64 +129,53 @@ class Injector(object):
             gdb_path (str): executable gdb path.
             timeout (int): timeout seconds.
             verbose (int): verbose level.
+            engine (str): inject engine in ENGINES, falls back to gdb,
+                auto uses remote_exec if target supports it.
+            stub (str): code run after code in its namespace, never
+                compiled or cached, for arguments which differ each run.
 
         Returns:
         """
 
+        if engine not in self.ENGINES:
+            raise RequirementsInvalid('Unknown inject engine %s.' % engine)
+        self.engine = engine
         self.gdb = gdb_path
         self.timeout = timeout
         self.verbose = verbose
+        self.stub = stub
 
         self.env_detect()
         self.ensure_pid(pid)
         self.temp_file = None
         self.code_file = None
-        self.ensure_code_file(code, file_path)
+        # compile code files, if target can load code objects
+        self.compile_codes = None
+        self.delivery = Delivery(self.pid)
+        # remote_exec script left to target, not confirmed to run
+        self.scheduled = False
+        # code is optional for an injector only used to open sessions
+        if code or file_path:
+            self.ensure_code_file(code, file_path)
 
         atexit.register(self.cleanup)
 
     def env_detect(self):
         """"""
-        # check platform
-        self.env = env = {}
-        if 'BSD' in platform.platform():
-            env['bsd'] = True
+        self.env = env = detect_env()
+        if env.get('bsd'):
             self.run = self._bsd_run
+        if self.engine == 'gdb':
+            self.check_gdb()
+        if env.get('ptrace_disabled'):
+            raise RequirementsInvalid(PTRACE_REQ_MSG)
 
-        try:
-            with open('/etc/lsb-release', 'rb') as f:
-                lsb_release = f.read()
-            distrib = re.search(b'DISTRIB_ID=(.+)', lsb_release, re.MULTILINE).groups()[0]
-            if distrib == b'Ubuntu':
-                env['ubuntu'] = True
-        except Exception:
-            pass
-
-        # check gdb
+    def check_gdb(self):
+        """"""
         if not os.access(self.gdb, os.X_OK):
             raise RequirementsInvalid(
                 'gdb is not exist or not executable.'
             )
-        # check ptrace
-        ptrace_scope = '/proc/sys/kernel/yama/ptrace_scope'
-        ptrace_req_msg = ('ptrace is disabled, enable it by:'
-                          'echo 0 | sudo tee /proc/sys/kernel/yama/ptrace_scope . '
-                          'arg --privileged may be also needed for docker '
-                          'exec/run command to override ptrace_scope.')
-        if os.path.exists(ptrace_scope):
-            with open(ptrace_scope, 'r') as f:
-                value = int(f.read().strip())
-            if value == 1:
-                raise RequirementsInvalid(ptrace_req_msg)
-        else:
-            getsebool = '/usr/sbin/getsebool'
-            if os.path.exists(getsebool):
-                p = subprocess.Popen(
-                    [getsebool, 'deny_ptrace'],
-                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                out, err = p.communicate()
-                if 'deny_ptrace --> on' in out:
-                    raise RequirementsInvalid(ptrace_req_msg)
 
     def cleanup(self):
         """"""
@@ -109,6 +184,7 @@ class Injector(object):
                 os.unlink(self.temp_file)
             except:
                 pass
+        self.delivery.cleanup()
 
     def ensure_code_file(self, code, file_path):
         """"""
@@ -129,85 +205,130 @@ class Injector(object):
                 raise RequirementsInvalid(
                     'Neither code nor code file_path specified.'
                 )
-        st = os.stat(self.code_file)
-        os.chmod(self.code_file,
-                 st.st_mode | stat.S_IREAD | stat.S_IRGRP | stat.S_IROTH)
 
     def ensure_pid(self, pid):
         """"""
-        ps_cmd = "ps ax | awk '{print $1}' | grep -w %s" % pid
-        if not pid or not getoutput(ps_cmd):
+        if not pid or not process_exists(pid):
             raise RequirementsInvalid('Process %s not exist.' % pid)
         self.pid = pid
 
-    def generate_gdb_codes(self):
-        """Generate gdb command codes
+    def generate_python_codes(self, code_files=None, inline=False):
+        """Generate python codes run by PyRun_SimpleString in target
         Args:
+            code_files (list): code files to run, default is self.code_file
+            inline (bool): embed code in the strings, for engines writing
+                them into target directly, otherwise deliver files
         Returns:
-            list: gdb command code lines
+            list: python code strings, prepare, run for each file, cleanup
         """
 
+        code_files = code_files or [self.code_file]
         lib_path = os.path.abspath(
             os.path.join(os.path.abspath(__file__), '../..')
         )
-        inject_paths = [
-            # TODO to support injected code file's path
-            # cannot support docker container
-            # os.path.dirname(self.code_file),
+        # host paths mean nothing in another mount namespace, unless
+        # mounted into it, e.g. a virtualenv shared with a container
+        inject_paths = self.delivery.target_paths([
             # current path, not used
             os.getcwd(),
             lib_path
-        ]
+        ])
         temp_sys_name = '_pylane_sys'
+        # only add missing paths and remove them by value, after all code
+        # files run, in case target or injected code changes sys.path
         prepare_code = ' '.join([
             'import sys as %s;' % temp_sys_name,
-            '%s.path.extend([%s]);' % (
-                temp_sys_name,
-                ','.join(['\\\"%s\\\"' % p for p in inject_paths])
-            )
+            # double quoted, codes are single quoted in gdb shell command
+            'exec("%s");' % RUN_HELPER.replace('"', '\\"').replace(
+                '\n', '\\n'),
+            '_pylane_paths = [p for p in [%s] if p not in %s.path];' % (
+                ','.join(['"%s"' % p for p in inject_paths]),
+                temp_sys_name
+            ),
+            '%s.path.extend(_pylane_paths);' % temp_sys_name,
+            '_pylane_pending = [None] * %d;' % len(code_files),
         ])
-        # deprecated, cause its hard to pass python code in shell args
-        # exec code is passed by shell command line, so add \\\" and \\\\n
-        # run_code = 'exec(\\\"%s\\\")' % (self.code.replace('\n', '\\\\n'))
+        run_codes = []
+        for code_file in code_files:
+            data, compiled = self.code_data(code_file)
+            read_code = [
+                '__raw_code = %s;' % self.delivery.read_code(data, inline),
+            ]
+            if compiled:
+                # target only unmarshals code object, no compiling
+                read_code.append(
+                    '__raw_code = __import__("marshal").loads(__raw_code);')
+            stub = self.stub if code_file == self.code_file else None
+            read_code.append('__stub = %s;' % (
+                self.delivery.read_code(stub.encode('utf-8'), inline)
+                if stub else 'None'))
+            if sys.version_info.major == 2:
+                run_code = ' '.join(read_code + [
+                    # python 2 donot support exec as Thread's target param
+                    'exec(__raw_code);',
+                    'exec(__stub or "pass");',
+                    'del __raw_code, __stub;'
+                ])
+            else:
+                run_code = ' '.join(read_code + [
+                    # run code async and stop injection early to keep target process safe
+                    'from threading import Thread as __Thread;'
+                    '__thread = __Thread(target=_pylane_run, args=('
+                    '__raw_code, _pylane_paths, _pylane_pending, __stub));'
+                    '__thread.daemon = True;'
+                    '__thread.start();'
+                    'del __raw_code, __stub;'
+                    'del __Thread;'
+                    'del __thread;'
+                ])
+            run_codes.append(run_code)
         if sys.version_info.major == 2:
-            run_code = ' '.join([
-                '__code_file = open(\\\"%s\\\");' % self.code_file,
-                '__raw_code = __code_file.read();',
-                '__code_file.close();',
-                # python 2 donot support exec as Thread's target param
-                'exec(__raw_code);',
-                'del __code_file;',
-                'del __raw_code;'
+            # code files already run, nothing pending
+            cleanup_code = ' '.join([
+                '[%s.path.remove(p) for p in _pylane_paths if p in %s.path];'
+                % (temp_sys_name, temp_sys_name),
             ])
         else:
-            run_code = ' '.join([
-                '__code_file = open(\\\"%s\\\");' % self.code_file,
-                '__raw_code = __code_file.read();',
-                '__code_file.close();',
-                # run code async and stop injection early to keep target process safe
-                'from threading import Thread as __Thread;'
-                '__thread = __Thread(target=exec, args=(__raw_code,));'
-                '__thread.daemon = True;'
-                '__thread.start();'
-                'del __code_file;'
-                'del __raw_code;'
-                'del __Thread;'
-                'del __thread;'
-            ])
-        # TODO injected code may change path as well
-        cleanup_code = ' '.join([
-            '%s.path = %s.path[:-%s];' % (
-                temp_sys_name,
-                temp_sys_name,
-                len(inject_paths)
-            )
-        ])
+            # threads remove paths once their imports are done
+            cleanup_code = ''
+        cleanup_code += ' del %s, _pylane_paths, _pylane_pending, ' \
+            '_pylane_read, _pylane_run;' % temp_sys_name
+        return [prepare_code] + run_codes + [cleanup_code.strip()]
+
+    def code_data(self, code_file):
+        """read a code file, compile it by payload cache if target can
+        load the code object
+        Returns:
+            tuple: (bytes of source or marshal data, compiled)
+        """
+        with open(code_file, 'rb') as f:
+            source = f.read()
+        if self.compile_codes is None:
+            from .payload import compatible
+            self.compile_codes = compatible(self.target_version())
+        if self.compile_codes:
+            from .payload import payload_cache
+            data = payload_cache.get(source)
+            if data is not None:
+                return data, True
+        return source, False
+
+    def generate_gdb_codes(self, code_files=None):
+        """Generate gdb command codes
+        Args:
+            code_files (list): code files to run, default is self.code_file
+        Returns:
+            list: gdb command code lines
+        """
+        # python code is passed in a c string, escape it
         return [
             # use char in case of symbol PyGilState_STATE not found
             'call $gil_state = (char) PyGILState_Ensure()',
-            'call (void) PyRun_SimpleString("%s")' % prepare_code,
-            'call (void) PyRun_SimpleString("%s")' % run_code,
-            'call (void) PyRun_SimpleString("%s")' % cleanup_code,
+        ] + [
+            'call (void) PyRun_SimpleString("%s")' % (
+                code.replace('\\', '\\\\').replace('"', '\\"'))
+            for code in self.generate_python_codes(code_files)
+        ] + [
             # make sure previous codes are safe.
             # gdb exit without GIL release is a disaster for target process.
             'call (void) PyGILState_Release($gil_state)',
@@ -215,11 +336,99 @@ class Injector(object):
 
     def timeout_exit(self, process):
         print("timeout in %s secs, exit." % self.timeout)
+        self.timed_out = True
         os.kill(process.pid, signal.SIGTERM)
 
     def inject(self):
         """Run inject"""
+        if not self.code_file:
+            raise RequirementsInvalid(
+                'Neither code nor code file_path specified.'
+            )
+        if self.engine == 'ptrace':
+            from .ptrace import PtraceInjector, PtraceUnavailable
+            try:
+                stop = PtraceInjector(
+                    self.pid, self.timeout, self.verbose
+                ).run(self.generate_python_codes(inline=True))
+                if self.verbose:
+                    print('target stopped %.3fs' % stop)
+                self.cleanup()
+                return True
+            except PtraceUnavailable as e:
+                print('ptrace engine unavailable, fall back to gdb: %s' % e)
+                self.check_gdb()
+        elif self.engine in ('auto', 'remote_exec'):
+            reason = self.remote_exec_unavailable()
+            if not reason:
+                return self.remote_exec_inject()
+            if self.engine == 'remote_exec' or self.verbose:
+                print('remote_exec engine unavailable, fall back to gdb: %s'
+                      % reason)
+            self.check_gdb()
+        return self.gdb_inject()
+
+    def target_version(self):
+        """python version tuple (major, minor) of target, None if unknown"""
+        if not procfs.available():
+            return None
+        found = procfs.find_python_object(self.pid)
+        version = found and found[1]['version']
+        return tuple(version) if version else None
+
+    def remote_exec_unavailable(self):
+        """Returns: str: reason why remote_exec is unavailable, or None"""
+        if not hasattr(sys, 'remote_exec'):
+            return 'sys.remote_exec needs python 3.14+ to run pylane.'
+        version = self.target_version()
+        if version != tuple(sys.version_info[:2]):
+            return 'target python version %s is not %s.' % (
+                version and '%s.%s' % version,
+                '%s.%s' % tuple(sys.version_info[:2]))
+        return None
+
+    def remote_exec_inject(self):
+        """Run inject by sys.remote_exec of PEP 768, target runs the script
+        at its next safe point without being stopped by a debugger.
+        Returns False with scheduled set if target not reach a safe point
+        in timeout, the script may still run later.
+        """
+        # script removes itself once consumed, code is inline
+        (fd, script_file, target_file) = self.delivery.reserve(suffix='.py')
+        codes = self.generate_python_codes(inline=True)
+        with os.fdopen(fd, 'w') as f:
+            f.write('try:\n')
+            for code in codes:
+                f.write('    %s\n' % code)
+            f.write('finally:\n')
+            f.write('    __import__("os").remove("%s")\n' % target_file)
+        try:
+            sys.remote_exec(self.pid, target_file)
+        except Exception as e:
+            self.delivery.cleanup()
+            if self.engine == 'remote_exec' or self.verbose:
+                print('remote_exec failed, fall back to gdb: %s' % e)
+            self.check_gdb()
+            return self.gdb_inject()
+
+        deadline = time.time() + self.timeout
+        while os.path.exists(script_file):
+            if time.time() > deadline:
+                # leave script to target, it runs script at next safe point
+                self.delivery.forget()
+                self.scheduled = True
+                print('target not reach a safe point in %s secs, script is '
+                      'scheduled, not confirmed, it runs at next safe point.'
+                      % self.timeout)
+                return False
+            time.sleep(0.01)
+        self.cleanup()
+        return True
+
+    def gdb_inject(self):
+        """Run inject by gdb"""
         codes = self.generate_gdb_codes()
+        self.timed_out = False
         process = self.run(codes)
         timer = Timer(self.timeout, self.timeout_exit, (process,))
         out = b''
@@ -234,12 +443,22 @@ class Injector(object):
                 print('stdout:', out)
                 print('stderr:', err)
                 print(err)
-            if b'Operation not permitted' in err:
-                print('Cannot attach a process without perm.')
-                if self.env.get('ubuntu'):
-                    print('You may need root perm to use ptrace in Ubuntu.')
-                exit(1)
-        return True
+        if b'Operation not permitted' in err:
+            raise InjectFailed(self.perm_denied_message())
+        return not self.timed_out
+
+    def perm_denied_message(self):
+        msg = 'Cannot attach a process without perm.'
+        if self.env.get('ubuntu'):
+            msg += '\nYou may need root perm to use ptrace in Ubuntu.'
+        return msg
+
+    def session(self):
+        """Open a long-lived gdb session attached to target.
+        Returns:
+            InjectSession: use it in a with statement.
+        """
+        return InjectSession(self)
 
     def _bsd_run(self, codes):
         """gdb under bsd can only run command in a file"""
@@ -279,6 +498,196 @@ class Injector(object):
         )
 
 
+class InjectSession(object):
+    """Drive one gdb over its MI interface to inject code files in batches.
+    gdb starts once and keeps symbols loaded, each batch attaches target,
+    runs all queued code files under a single GIL window and detaches.
+    """
+
+    def __init__(self, injector):
+        self.injector = injector
+        self.process = None
+        self.token = 0
+        self.queued = []
+        self.temp_files = []
+        self.startup_time = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def start(self):
+        """start gdb in mi mode, wait for its first prompt"""
+        self.injector.check_gdb()
+        start = time.time()
+        self.process = subprocess.Popen(
+            [self.injector.gdb, '--interpreter=mi2', '-q', '-nx'],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE
+        )
+        self.read_until_prompt()
+        self.command('-gdb-set confirm off')
+        self.command('-gdb-set pagination off')
+        self.startup_time = time.time() - start
+
+    def queue(self, code=None, file_path=None):
+        """queue a code or code file to run in next batch"""
+        if file_path:
+            file_path = os.path.abspath(file_path)
+            if not os.path.isfile(file_path):
+                raise RequirementsInvalid(
+                    'Arg file_path is not a valid file.'
+                )
+        elif code:
+            (fd, file_path) = tempfile.mkstemp()
+            with os.fdopen(fd, 'w') as f:
+                f.write(code)
+            self.temp_files.append(file_path)
+        else:
+            raise RequirementsInvalid(
+                'Neither code nor code file_path specified.'
+            )
+        self.queued.append(file_path)
+
+    def flush(self):
+        """attach target, run all queued code files, detach
+        Returns:
+            dict: batch report, codes count, attach and target stop seconds
+        """
+        code_files, self.queued = self.queued, []
+        if not code_files:
+            return None
+        codes = self.injector.generate_gdb_codes(code_files)
+        start = time.time()
+        try:
+            self.command('-target-attach %d' % self.injector.pid)
+        except InjectFailed as e:
+            if 'Operation not permitted' in str(e):
+                raise InjectFailed(self.injector.perm_denied_message())
+            raise
+        attached = time.time()
+        # codes are ensure GIL, run code files and release GIL, release
+        # must run once ensure did, gdb -batch runs it after failures too
+        ensured = False
+        try:
+            for code in codes[:-1]:
+                self.console(code)
+                ensured = True
+        finally:
+            try:
+                if ensured:
+                    self.console(codes[-1])
+            finally:
+                self.command('-target-detach')
+        end = time.time()
+        self.cleanup()
+        report = {
+            'codes': len(code_files),
+            'attach': attached - start,
+            'stop': end - start,
+        }
+        if self.startup_time is not None:
+            report['startup'] = self.startup_time
+            self.startup_time = None
+        return report
+
+    def console(self, code):
+        """run a gdb console command"""
+        return self.command('-interpreter-exec console "%s"' % (
+            code.replace('\\', '\\\\').replace('"', '\\"')))
+
+    def command(self, command):
+        """send a mi command and wait for its result record
+        Returns:
+            list: result record and stream records before it
+        """
+        self.token += 1
+        prefix = '%d^' % self.token
+        self.process.stdin.write(
+            ('%d%s\n' % (self.token, command)).encode('utf-8'))
+        self.process.stdin.flush()
+        lines = self.read_until_prompt()
+        for line in lines:
+            if not line.startswith(prefix):
+                continue
+            if line.startswith(prefix + 'error'):
+                raise InjectFailed('gdb command failed: %s\n%s' % (
+                    command, line[len(prefix):]))
+            return lines
+        raise InjectFailed('gdb result of command not found: %s' % command)
+
+    def read_until_prompt(self):
+        """read mi output records until gdb prompt, bounded by timeout"""
+        timer = Timer(self.injector.timeout,
+                      self.injector.timeout_exit, (self.process,))
+        lines = []
+        try:
+            timer.start()
+            while True:
+                line = self.process.stdout.readline()
+                if not line:
+                    raise InjectFailed('gdb exited unexpectedly.')
+                line = line.decode('utf-8', 'replace').rstrip('\r\n')
+                if self.injector.verbose:
+                    print(line)
+                if line.strip() == '(gdb)':
+                    return lines
+                lines.append(line)
+        finally:
+            timer.cancel()
+
+    def cleanup(self):
+        self.injector.delivery.cleanup()
+        for temp_file in self.temp_files:
+            try:
+                os.unlink(temp_file)
+            except:
+                pass
+        self.temp_files = []
+
+    def close(self):
+        """quit gdb, the target is always detached after each batch"""
+        self.cleanup()
+        if not self.process:
+            return
+        try:
+            self.process.stdin.write(b'-gdb-exit\n')
+            self.process.stdin.flush()
+            self.process.communicate()
+        except Exception:
+            self.process.kill()
+        self.process = None
+
+
+def format_report(report):
+    """format batch report of an inject session"""
+    line = 'injected %s code files, attach %.3fs, target stopped %.3fs' % (
+        report['codes'], report['attach'], report['stop'])
+    if 'startup' in report:
+        line += ', gdb startup %.3fs' % report['startup']
+    return line
+
+
 @PylaneExceptionHandler
 def inject(*args, **kwargs):
     return Injector(*args, **kwargs).inject()
+
+
+@PylaneExceptionHandler
+def inject_session(pid, file_paths, batches=None, **kwargs):
+    """Inject code files in one attached batch, then a batch for each
+    list of file paths in batches, with a single gdb process.
+    """
+    injector = Injector(pid=pid, **kwargs)
+    with injector.session() as session:
+        for batch in itertools.chain([file_paths], batches or []):
+            for file_path in batch:
+                session.queue(file_path=file_path)
+            report = session.flush()
+            if report:
+                print(format_report(report))
+    return True
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compile code files once, cache marshal data of their code objects on disk,
+so targets of the same python version only unmarshal them instead of
+compiling under their GIL.
+"""
+
+import os
+import sys
+import marshal
+import hashlib
+import platform
+import tempfile
+from . import procfs
+
+
+# code objects are only loadable by the same python version
+CACHE_TAG = getattr(getattr(sys, 'implementation', None), 'cache_tag', None) \
+    or 'cpython-%d%d' % sys.version_info[:2]
+
+
+def compatible(version):
+    """
+    Args:
+        version (tuple): (major, minor) of target python
+    Returns:
+        bool: if code objects compiled here are loadable by target
+    """
+    return platform.python_implementation() == 'CPython' and \
+        tuple(version or ()) == tuple(sys.version_info[:2])
+
+
+class PayloadCache(object):
+    """Marshal data of compiled code, keyed by source hash and version."""
+
+    # oldest are dropped, e.g. of edited code files
+    SIZE = 256
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(procfs.cache_dir(), 'payloads')
+
+    def key(self, source):
+        if not isinstance(source, bytes):
+            source = source.encode('utf-8')
+        return '%s.%s' % (hashlib.sha1(source).hexdigest(), CACHE_TAG)
+
+    def get(self, source):
+        """marshal data of source, compile and save it if not cached
+        Returns:
+            bytes: marshal data, None if source has syntax errors
+        """
+        path = os.path.join(self.path, self.key(source))
+        # names are predictable, code objects run in target are only
+        # trusted from a file nobody else could write
+        if procfs.private(self.path) and procfs.private(path):
+            try:
+                with open(path, 'rb') as f:
+                    return f.read()
+            except (IOError, OSError):
+                pass
+        try:
+            # same file name as exec of source, for same tracebacks
+            data = marshal.dumps(compile(source, '<string>', 'exec'))
+        except (SyntaxError, ValueError):
+            # leave errors to target, as raw source does
+            return None
+        self.save(path, data)
+        return data
+
+    def save(self, path, data):
+        if not procfs.ensure_private_dir(self.path):
+            return
+        try:
+            # write to a temp file then rename, for parallel injections
+            (fd, temp_path) = tempfile.mkstemp(dir=self.path)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.rename(temp_path, path)
+            self.prune()
+        except (IOError, OSError):
+            pass
+
+    def prune(self):
+        names = os.listdir(self.path)
+        if len(names) <= self.SIZE:
+            return
+        paths = sorted(
+            (os.path.join(self.path, name) for name in names),
+            key=os.path.getmtime)
+        for path in paths[:len(paths) - self.SIZE]:
+            os.remove(path)
+
+
+payload_cache = PayloadCache()
@@ -0,0 +1,326 @@
+# -*- coding: utf-8 -*-
+
+"""
+Scan python processes by /proc, cache facts of python binaries on disk.
+"""
+
+import os
+import re
+import json
+import stat
+import tempfile
+import threading
+from .elf import ElfFile
+from .exception import PylaneException
+
+
+# symbols of python c api pylane may call, cached with binary facts
+PYTHON_SYMBOLS = [
+    'Py_Initialize',
+    'PyGILState_Ensure',
+    'PyRun_SimpleString',
+    'PyGILState_Release',
+    # static, only in symtab of unstripped builds
+    'take_gil',
+]
+
+PYTHON_EXE_RE = re.compile(r'^python[\d.]*$')
+
+
+def available():
+    return os.path.isdir('/proc/self')
+
+
+def read_file(path, mode='r'):
+    """read a proc file, None if not permitted or process gone"""
+    try:
+        with open(path, mode) as f:
+            return f.read()
+    except (IOError, OSError):
+        return None
+
+
+def readlink(path):
+    try:
+        return os.readlink(path)
+    except (IOError, OSError):
+        return None
+
+
+def list_pids():
+    return sorted(int(name) for name in os.listdir('/proc') if name.isdigit())
+
+
+def process_exists(pid):
+    return os.path.isdir('/proc/%d' % pid)
+
+
+def process_ppid(pid):
+    stat = read_file('/proc/%d/stat' % pid)
+    if not stat:
+        return None
+    # comm in stat may contain spaces, fields after its ')' are fixed
+    return int(stat[stat.rindex(')') + 2:].split()[1])
+
+
+def process_cmdline(pid):
+    cmdline = read_file('/proc/%d/cmdline' % pid, 'rb')
+    if not cmdline:
+        return ''
+    return cmdline.rstrip(b'\0').replace(b'\0', b' ').decode(
+        'utf-8', 'replace')
+
+
+def list_processes():
+    """
+    Returns:
+        list: [(pid, ppid, command)] of all processes
+    """
+    processes = []
+    for pid in list_pids():
+        ppid = process_ppid(pid)
+        if ppid is not None:
+            processes.append((pid, ppid, process_cmdline(pid)))
+    return processes
+
+
+def ns_pid(pid):
+    """pid seen inside target's own pid namespace"""
+    status = read_file('/proc/%d/status' % pid) or ''
+    for line in status.splitlines():
+        if line.startswith('NSpid:'):
+            return int(line.split()[-1])
+    return pid
+
+
+def ns_uid(pid, uid):
+    """uid of ours seen inside target's own user namespace"""
+    if uid is None:
+        return None
+    uid_map = read_file('/proc/%d/uid_map' % pid) or ''
+    for line in uid_map.splitlines():
+        inside, outside, count = [int(n) for n in line.split()]
+        if outside <= uid < outside + count:
+            return inside + uid - outside
+    return uid
+
+
+def namespace(pid):
+    """mount namespace of pid, None if it is the same as ours"""
+    target = readlink('/proc/%d/ns/mnt' % pid)
+    if target and target != readlink('/proc/self/ns/mnt'):
+        return target
+    return None
+
+
+def target_path(pid, path):
+    """path of a target file, seen from our mount namespace"""
+    root_path = '/proc/%d/root%s' % (pid, path)
+    return root_path if os.path.exists(root_path) else path
+
+
+def mapped_objects(pid):
+    """
+    Returns:
+        list: [(path, load start)] of files mapped by pid, in map order
+    """
+    maps = read_file('/proc/%d/maps' % pid)
+    if not maps:
+        return []
+    objects = []
+    seen = set()
+    for line in maps.splitlines():
+        parts = line.split(None, 5)
+        if len(parts) < 6 or not parts[5].startswith('/'):
+            continue
+        path = parts[5].strip()
+        if int(parts[2], 16) == 0 and path not in seen:
+            seen.add(path)
+            objects.append((path, int(parts[0].split('-')[0], 16)))
+    return objects
+
+
+def cache_dir():
+    """directory of pylane caches"""
+    cache_home = os.environ.get('XDG_CACHE_HOME') or \
+        os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'pylane')
+
+
+def private(path):
+    """if path is ours, not a symlink and not writable by others, caches
+    may be read by pylane run as root, with HOME of another user"""
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    return not stat.S_ISLNK(st.st_mode) and st.st_uid == os.geteuid() and \
+        not st.st_mode & 0o022
+
+
+def ensure_private_dir(path):
+    """
+    Returns:
+        bool: if dir path exists or is created, and is private
+    """
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path, 0o700)
+        except OSError:
+            return False
+    return private(path)
+
+
+class BinaryCache(object):
+    """Facts of python binaries in a json file, keyed by build id."""
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(cache_dir(), 'binaries.json')
+        self._facts = None
+        # shared by injector threads of a fleet
+        self.lock = threading.RLock()
+
+    @property
+    def facts(self):
+        with self.lock:
+            if self._facts is None:
+                self._facts = self.load()
+            return self._facts
+
+    def load(self):
+        # symbol addresses are called by the ptrace engine, only trust
+        # a file nobody else could write
+        if not (private(os.path.dirname(self.path)) and private(self.path)):
+            return {}
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def key(self, elf):
+        build_id = elf.build_id
+        if build_id:
+            return build_id
+        st = os.stat(elf.path)
+        return 'path:%s:%s:%s' % (elf.path, st.st_size, int(st.st_mtime))
+
+    def get(self, path):
+        """facts of a binary, parse and save them if not cached
+        Returns:
+            dict: version, build_id, load_vaddr, PYTHON_SYMBOLS values
+                and sizes
+        """
+        elf = ElfFile(path)
+        try:
+            key = self.key(elf)
+            # facts cached before sizes were kept are parsed again
+            facts = self.facts.get(key)
+            if facts and 'sizes' in facts:
+                return facts
+            symbols = dict(
+                (name, elf.symbols[name])
+                for name in PYTHON_SYMBOLS if name in elf.symbols
+            )
+            version = elf.python_version() if symbols else None
+            facts = {
+                'build_id': elf.build_id,
+                'version': list(version) if version else None,
+                'load_vaddr': elf.load_vaddr,
+                'symbols': symbols,
+                'sizes': dict(
+                    (name, elf.sizes[name]) for name in symbols),
+            }
+        finally:
+            elf.close()
+        with self.lock:
+            self.facts[key] = facts
+            self.save()
+        return facts
+
+    def save(self):
+        dir_path = os.path.dirname(self.path)
+        if not ensure_private_dir(dir_path):
+            return
+        try:
+            # write to a temp file then rename, for parallel injections
+            (fd, temp_path) = tempfile.mkstemp(dir=dir_path)
+            with os.fdopen(fd, 'w') as f:
+                with self.lock:
+                    json.dump(self.facts, f)
+            os.rename(temp_path, self.path)
+        except (IOError, OSError):
+            pass
+
+
+binary_cache = BinaryCache()
+
+
+def find_python_object(pid, names=('Py_Initialize',)):
+    """find the python binary or libpython mapped by target,
+    which defines all symbols in names.
+    Args:
+        pid (int): target pid.
+        names (list): symbol names in PYTHON_SYMBOLS.
+    Returns:
+        tuple: (path, facts, load bias), or None if not found.
+    """
+    exe = readlink('/proc/%d/exe' % pid)
+    for path, start in mapped_objects(pid):
+        if path != exe and \
+                not os.path.basename(path).startswith('libpython'):
+            continue
+        try:
+            facts = binary_cache.get(target_path(pid, path))
+        except (IOError, OSError, ValueError, PylaneException):
+            continue
+        if all(name in facts['symbols'] for name in names):
+            return path, facts, start - facts['load_vaddr']
+    return None
+
+
+def python_process(pid):
+    """
+    Returns:
+        dict: facts of a python process, or None if not python
+    """
+    exe = readlink('/proc/%d/exe' % pid)
+    if not exe:
+        return None
+    maps = read_file('/proc/%d/maps' % pid) or ''
+    if not PYTHON_EXE_RE.match(os.path.basename(exe)) and \
+            'libpython' not in maps:
+        return None
+    info = {
+        'pid': pid,
+        'ppid': process_ppid(pid),
+        'cmdline': process_cmdline(pid),
+        'exe': exe,
+        'namespace': namespace(pid),
+        'version': None,
+        'libpython': None,
+        'build_id': None,
+    }
+    found = find_python_object(pid)
+    if found:
+        path, facts, _ = found
+        info['version'] = facts['version'] and tuple(facts['version'])
+        info['build_id'] = facts['build_id']
+        if path != exe:
+            info['libpython'] = path
+    return info
+
+
+def python_processes():
+    """
+    Returns:
+        list: facts dict of each python process
+    """
+    processes = []
+    for pid in list_pids():
+        if pid == os.getpid():
+            continue
+        info = python_process(pid)
+        if info:
+            processes.append(info)
+    return processes
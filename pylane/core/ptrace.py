@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+
+"""
+gdb-free inject engine, call python c api in target by ptrace directly.
+Only linux x86_64 is supported.
+"""
+
+import os
+import time
+import signal
+import struct
+import ctypes
+import ctypes.util
+import platform
+from .procfs import find_python_object
+from .exception import PylaneException, InjectFailed
+
+
+PTRACE_CONT = 7
+PTRACE_GETREGS = 12
+PTRACE_SETREGS = 13
+PTRACE_DETACH = 17
+PTRACE_SEIZE = 0x4206
+PTRACE_INTERRUPT = 0x4207
+WALL = 0x40000000
+AT_ENTRY = 9
+NO_SYSCALL = ctypes.c_ulong(-1).value
+# futex and futex_waitv, the thread may be waiting for GIL
+LOCK_SYSCALLS = (202, 449)
+# bytes on top of stack searched for return addresses into take_gil
+STACK_SCAN = 2048
+# seconds to retry a lock wait if take_gil is unknown, GIL waits last
+# about a switch interval
+UNKNOWN_LOCK_WAIT = 1
+
+# call *%rax; int3
+CALL_STUB = b'\xff\xd0\xcc'
+RED_ZONE = 128
+
+SYMBOLS = ['PyGILState_Ensure', 'PyRun_SimpleString', 'PyGILState_Release']
+
+
+class PtraceUnavailable(PylaneException):
+    """ptrace engine cannot work on target, nothing is run yet."""
+    pass
+
+
+class UserRegs(ctypes.Structure):
+    """struct user_regs_struct of x86_64"""
+    _fields_ = [(name, ctypes.c_ulong) for name in (
+        'r15', 'r14', 'r13', 'r12', 'rbp', 'rbx', 'r11', 'r10', 'r9', 'r8',
+        'rax', 'rcx', 'rdx', 'rsi', 'rdi', 'orig_rax', 'rip', 'cs', 'eflags',
+        'rsp', 'ss', 'fs_base', 'gs_base', 'ds', 'es', 'fs', 'gs',
+    )]
+
+
+class PtraceInjector(object):
+    """Attach target by ptrace, run python codes by calling
+    PyGILState_Ensure, PyRun_SimpleString and PyGILState_Release.
+    """
+
+    def __init__(self, pid, timeout=10, verbose=0):
+        """
+        Args:
+            pid (int): target pid.
+            timeout (int): seconds to wait for a safe point, and for
+                target to finish a call before abandoning it.
+            verbose (int): verbose level.
+        """
+        self.pid = pid
+        self.timeout = timeout
+        self.verbose = verbose
+        self.check_platform()
+        self.libc = ctypes.CDLL(
+            ctypes.util.find_library('c') or None, use_errno=True)
+        self.libc.ptrace.restype = ctypes.c_long
+        self.libc.ptrace.argtypes = [
+            ctypes.c_long, ctypes.c_long, ctypes.c_void_p, ctypes.c_void_p]
+        self.attached = False
+        # a call not finished in timeout can not be taken back
+        self.abandoned = False
+        # address range of take_gil, None if not in symbols
+        self.take_gil = None
+
+    def check_platform(self):
+        if platform.system() != 'Linux' or \
+                platform.machine() not in ('x86_64', 'amd64'):
+            raise PtraceUnavailable(
+                'ptrace engine only supports linux x86_64.')
+
+    def find_functions(self):
+        """find runtime address of python c api functions in target
+        Returns:
+            dict: {symbol name: address}
+        """
+        found = find_python_object(self.pid, SYMBOLS)
+        if not found:
+            raise PtraceUnavailable(
+                'symbols %s not found in target.' % ', '.join(SYMBOLS))
+        path, facts, bias = found
+        if self.verbose:
+            print('python symbols found in', path)
+        address = facts['symbols'].get('take_gil')
+        size = facts.get('sizes', {}).get('take_gil')
+        if address and size:
+            self.take_gil = (address + bias, address + bias + size)
+        return dict(
+            (name, facts['symbols'][name] + bias) for name in SYMBOLS
+        )
+
+    def find_entry(self):
+        """AT_ENTRY of target, never executed again, used as call stub"""
+        try:
+            with open('/proc/%d/auxv' % self.pid, 'rb') as f:
+                auxv = f.read()
+        except (IOError, OSError) as e:
+            raise PtraceUnavailable('read auxv of target failed: %s' % e)
+        for i in range(0, len(auxv), 16):
+            key, value = struct.unpack_from('<QQ', auxv, i)
+            if key == AT_ENTRY:
+                return value
+        raise PtraceUnavailable('AT_ENTRY not found in target auxv.')
+
+    def ptrace(self, request, addr=None, data=None):
+        ret = self.libc.ptrace(request, self.pid, addr, data)
+        if ret == -1:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return ret
+
+    def wait_stop(self, expected, deadline=None):
+        """wait target stopped by expected signal, deliver others,
+        after deadline stop target and raise InjectFailed"""
+        while True:
+            options = WALL | (os.WNOHANG if deadline else 0)
+            pid, status = os.waitpid(self.pid, options)
+            if not pid:
+                if time.time() > deadline:
+                    # stopped target can be restored and detached
+                    self.interrupt()
+                    raise InjectFailed(
+                        'Target not finish injected call in %s secs.'
+                        % self.timeout)
+                time.sleep(0.001)
+                continue
+            if os.WIFEXITED(status) or os.WIFSIGNALED(status):
+                self.attached = False
+                raise InjectFailed('Target process exited.')
+            sig = os.WSTOPSIG(status)
+            if sig == expected:
+                return
+            if sig == signal.SIGSEGV:
+                raise InjectFailed('Target crashed in injected call.')
+            self.ptrace(PTRACE_CONT, None, sig)
+
+    def interrupt(self):
+        """stop the running target"""
+        self.ptrace(PTRACE_INTERRUPT)
+        self.wait_stop(signal.SIGTRAP)
+
+    def in_take_gil(self, mem, regs):
+        """
+        Returns:
+            bool: if the stopped thread is inside take_gil, by rip or a
+                return address on top of its stack, None if unknown
+        """
+        if self.take_gil is None:
+            return None
+        start, end = self.take_gil
+        if start <= regs.rip < end:
+            return True
+        try:
+            mem.seek(regs.rsp)
+            data = mem.read(STACK_SCAN)
+        except (IOError, OSError):
+            return None
+        words = struct.unpack_from('<%dQ' % (len(data) // 8), data)
+        return any(start <= word < end for word in words)
+
+    def stop_at_safe_point(self, mem):
+        """stop target where calling python c api is safe, raise
+        PtraceUnavailable if main thread keeps waiting for GIL
+        Returns:
+            UserRegs: registers of stopped target
+        """
+        start = time.time()
+        delay = 0.001
+        while True:
+            self.interrupt()
+            regs = self.getregs()
+            if regs.orig_rax not in LOCK_SYSCALLS:
+                return regs
+            # taking GIL again from inside take_gil deadlocks all threads
+            # of target, other lock waits like Event.wait hold no GIL
+            waiting_gil = self.in_take_gil(mem, regs)
+            if waiting_gil is False:
+                return regs
+            wait = self.timeout if waiting_gil else UNKNOWN_LOCK_WAIT
+            if time.time() - start > wait:
+                raise PtraceUnavailable(
+                    'target main thread kept waiting %s in %s secs.' % (
+                        'for GIL' if waiting_gil else
+                        'on a lock, take_gil not found to tell GIL waits',
+                        wait))
+            self.ptrace(PTRACE_CONT)
+            time.sleep(delay)
+            delay = min(delay * 2, 0.05)
+
+    def getregs(self):
+        regs = UserRegs()
+        self.ptrace(PTRACE_GETREGS, None, ctypes.addressof(regs))
+        return regs
+
+    def setregs(self, regs):
+        self.ptrace(PTRACE_SETREGS, None, ctypes.addressof(regs))
+
+    def call(self, regs, stub, stack, func, arg):
+        """call func(arg) in target by stub, return rax"""
+        call_regs = UserRegs.from_buffer_copy(regs)
+        call_regs.rip = stub
+        call_regs.rax = func
+        call_regs.rdi = arg
+        call_regs.rsp = stack
+        # never restart an interrupted syscall in our call
+        call_regs.orig_rax = NO_SYSCALL
+        self.setregs(call_regs)
+        self.ptrace(PTRACE_CONT)
+        try:
+            self.wait_stop(signal.SIGTRAP, time.time() + self.timeout)
+        except InjectFailed:
+            self.abandoned = True
+            raise
+        return self.getregs().rax
+
+    def run(self, codes):
+        """attach target, run python codes, restore and detach
+        Args:
+            codes (list): python code strings, run one by one.
+        Returns:
+            float: seconds target stopped
+        """
+        functions = self.find_functions()
+        stub = self.find_entry()
+        start = time.time()
+        # seize and interrupt stops only the main thread, attach sends
+        # SIGSTOP to all threads, the one holding GIL would never release it
+        try:
+            self.ptrace(PTRACE_SEIZE)
+        except OSError as e:
+            raise PtraceUnavailable('ptrace seize failed: %s' % e)
+        self.attached = True
+        try:
+            try:
+                mem = open('/proc/%d/mem' % self.pid, 'r+b', 0)
+            except (IOError, OSError) as e:
+                raise PtraceUnavailable('open target memory failed: %s' % e)
+            with mem:
+                regs = self.stop_at_safe_point(mem)
+                mem.seek(stub)
+                origin_stub = mem.read(len(CALL_STUB))
+                mem.seek(stub)
+                mem.write(CALL_STUB)
+                try:
+                    self._run_codes(mem, regs, stub, functions, codes)
+                except InjectFailed as e:
+                    if self.abandoned and self.attached:
+                        raise InjectFailed(
+                            '%s Its stack and GIL can not be taken back, '
+                            'target is left stopped by SIGSTOP, '
+                            'restart it.' % e)
+                    raise
+                finally:
+                    # registers of an abandoned call are left, restored
+                    # ones would run on with GIL held and a thread state
+                    # pointing into the dropped stack
+                    if self.attached and not self.abandoned:
+                        mem.seek(stub)
+                        mem.write(origin_stub)
+                        self.setregs(regs)
+        finally:
+            if self.attached:
+                if self.abandoned:
+                    # pending, stops all threads once detached
+                    os.kill(self.pid, signal.SIGSTOP)
+                self.ptrace(PTRACE_DETACH)
+                self.attached = False
+        return time.time() - start
+
+    def _run_codes(self, mem, regs, stub, functions, codes):
+        gil_state = self.call(
+            regs, stub, (regs.rsp - RED_ZONE) & ~0xf,
+            functions['PyGILState_Ensure'], 0) & 0xffffffff
+        try:
+            for code in codes:
+                data = code.encode('utf-8') + b'\0'
+                address = (regs.rsp - RED_ZONE - len(data)) & ~0xf
+                mem.seek(address)
+                mem.write(data)
+                ret = self.call(
+                    regs, stub, (address - RED_ZONE) & ~0xf,
+                    functions['PyRun_SimpleString'], address)
+                if self.verbose:
+                    print('PyRun_SimpleString returns', ctypes.c_int(ret).value)
+        finally:
+            # never call after an abandoned call, it may still hold GIL
+            if not self.abandoned:
+                self.call(
+                    regs, stub, (regs.rsp - RED_ZONE) & ~0xf,
+                    functions['PyGILState_Release'], gil_state)
@@ -4,30 +4,197 @@
 Entry of Pylane
 """
 
+import sys
+import time
 import click
-from pylane.core.injector import inject as _inject
-from pylane.shell.shell import shell as _shell
+
+# subcommands import what they use in their bodies, so that a fleet of
+# inject runs never loads IPython, see benchmarks/bench_import.py
 
 
 @click.command()
-@click.argument('pid', type=int)
-@click.argument('file_path', type=click.Path(exists=True, readable=True))
+@click.argument('target')
+@click.argument('file_paths', nargs=-1, required=True,
+                type=click.Path(exists=True, readable=True))
+@click.option('-k', '--keep-attached', is_flag=True,
+              help='Run all files in one batch with a long-lived gdb, '
+                   'then read more batches from stdin, one batch per line. '
+                   'gdb stays, target is detached between batches.')
+@click.option('-r', '--resident', is_flag=True,
+              help='Leave a resident agent in target, reused by later calls.')
+@click.option('-c', '--children', is_flag=True,
+              help='Inject child processes of the pids instead.')
+@click.option('-m', '--match', is_flag=True,
+              help='TARGET is a regex to search process command lines.')
+@click.option('-j', '--jobs', type=int, default=8,
+              help='Max processes injected at the same time.')
 @click.pass_context
-def inject(ctx, pid, file_path):
-    """Inject a python process, run some code inside the vm."""
-    _inject(pid=pid, file_path=file_path, **ctx.obj)
+def inject(ctx, target, file_paths, keep_attached, resident,
+           children, match, jobs):
+    """Inject python processes, run some code inside the vm.
+
+    TARGET is a pid, pids split by comma, or a regex with --match.
+    """
+    from pylane.core.fleet import (
+        get_pids as _get_pids,
+        inject_fleet as _inject_fleet
+    )
+    from pylane.shell.agent import connect_agent as _connect_agent
+    pids = _get_pids(target, children, match)
+    if len(pids) > 1 or children or match:
+        ignored = [flag for flag, value in (
+            ('--keep-attached', keep_attached), ('--resident', resident))
+            if value]
+        if ignored:
+            print('%s ignored, only a single pid supports %s.' % (
+                ' and '.join(ignored), 'them' if len(ignored) > 1 else 'it'))
+        if not _inject_fleet(pids, file_paths, jobs=jobs, **ctx.obj):
+            sys.exit(1)
+        return
+    pid = pids[0]
+    agent = _connect_agent(dict(ctx.obj, pid=pid), resident)
+    if agent:
+        if keep_attached:
+            print('--keep-attached ignored, process %s has a resident agent, '
+                  'files are run by it.' % pid)
+        for file_path in file_paths:
+            with open(file_path) as f:
+                agent.inject(f.read())
+    elif keep_attached or len(file_paths) > 1:
+        from pylane.core.injector import inject_session as _inject_session
+        batches = None
+        if keep_attached and not sys.stdin.isatty():
+            batches = (line.split() for line in sys.stdin)
+        _inject_session(pid=pid, file_paths=file_paths, batches=batches,
+                        **ctx.obj)
+    else:
+        from pylane.core.injector import inject as _inject
+        if not _inject(pid=pid, file_path=file_paths[0], **ctx.obj):
+            sys.exit(1)
 
 
 @click.command()
 @click.argument('pid', type=int)
+@click.option('-r', '--resident', is_flag=True,
+              help='Leave a resident agent in target, reused by later calls.')
+@click.option('-s', '--stream', is_flag=True,
+              help='Print output of long running commands while they run.')
+@click.option('-z', '--compress-level', type=click.IntRange(0, 9), default=0,
+              help='Zlib level of large frames, for slow terminals, '
+                   '0 to disable.')
+@click.option('--timing', is_flag=True,
+              help='Print time of each startup step.')
 @click.pass_context
-def shell(ctx, pid):
+def shell(ctx, pid, resident, stream, compress_level, timing):
     """Create a remote python shell on a process."""
-    _shell(pid=pid, **ctx.obj)
+    # shell loads IPython, import it only when needed
+    from pylane.shell.shell import shell as _shell
+    _shell(pid=pid, resident=resident, stream=stream,
+           compress_level=compress_level, timing=timing, **ctx.obj)
+
+
+@click.command('exec')
+@click.argument('pid', type=int)
+@click.argument('code', required=False)
+@click.option('-f', '--file', 'file_obj', type=click.File('r'),
+              help='Read code from a file, - for stdin.')
+@click.option('--json', 'as_json', is_flag=True,
+              help='Print result as json.')
+@click.option('-w', '--call-timeout', type=int, default=30,
+              help='Seconds to wait for the result, 0 to wait forever.')
+@click.pass_context
+def exec_(ctx, pid, code, file_obj, as_json, call_timeout):
+    """Run code in a process, print its output and last expression value.
+
+    Exit status is 1 if code raised, 2 if no result in call timeout.
+    """
+    if file_obj:
+        code = file_obj.read()
+    if not code:
+        raise click.UsageError('Neither CODE nor --file specified.')
+    from pylane.shell.execute import execute as _execute
+    sys.exit(_execute(code, as_json=as_json, call_timeout=call_timeout,
+                      pid=pid, **ctx.obj))
+
+
+@click.command()
+@click.option('-l', '--long', 'long_format', is_flag=True,
+              help='Show full build id and command line.')
+def ps(long_format):
+    """List python processes with interpreter facts."""
+    from pylane.core.procfs import python_processes as _python_processes
+    print('%-8s %-8s %-7s %-12s %-10s %s' % (
+        'PID', 'PPID', 'PYTHON', 'BUILD-ID', 'CONTAINER', 'COMMAND'))
+    for info in _python_processes():
+        version = info['version']
+        build_id = info['build_id'] or '-'
+        command = info['cmdline']
+        if not long_format:
+            build_id = build_id[:12]
+            command = command[:80]
+        print('%-8s %-8s %-7s %-12s %-10s %s' % (
+            info['pid'], info['ppid'],
+            '%s.%s' % version if version else '?',
+            build_id,
+            'yes' if info['namespace'] else '-',
+            command))
+        if long_format and info['libpython']:
+            print('%-8s libpython: %s' % ('', info['libpython']))
+
+
+@click.group('agent')
+def agent_group():
+    """Manage resident agents."""
+
+
+@agent_group.command('list')
+def list_agents():
+    """List processes with a resident agent."""
+    from pylane.shell.agent import list_agents as _list_agents
+    for pid, info in _list_agents():
+        print('%s\t%s\t%s\tstarted at %s' % (
+            pid, info.get('kind', 'thread'), info['executable'],
+            time.strftime('%Y-%m-%d %H:%M:%S',
+                          time.localtime(info['started']))))
+
+
+@agent_group.command()
+@click.argument('pid', type=int)
+@click.option('-a', '--async', 'use_async', is_flag=True,
+              help='Serve all clients on an asyncio event loop, '
+                   'for python 3.5+ targets.')
+@click.pass_context
+def install(ctx, pid, use_async):
+    """Install a resident agent in a process."""
+    from pylane.shell.agent import (
+        find_agent as _find_agent,
+        install_agent as _install_agent
+    )
+    if _find_agent(pid):
+        print('Process %s already has a resident agent.' % pid)
+        exit(1)
+    _install_agent(dict(ctx.obj, pid=pid),
+                   kind='async' if use_async else 'thread')
+
+
+@agent_group.command()
+@click.argument('pid', type=int)
+def unload(pid):
+    """Unload resident agent of a process."""
+    from pylane.shell.agent import find_agent as _find_agent
+    agent_client = _find_agent(pid)
+    if not agent_client:
+        print('No resident agent in process %s.' % pid)
+        exit(1)
+    agent_client.unload()
 
 
 @click.group()
-@click.option('-g', '--gdb_path', type=click.Path(exists=True), default='/usr/bin/gdb')
+@click.option('-g', '--gdb_path', type=click.Path(), default='/usr/bin/gdb')
+@click.option('--engine', default='auto',
+              type=click.Choice(['auto', 'gdb', 'ptrace', 'remote_exec']),
+              help='Inject engine, falls back to gdb if unavailable, '
+                   'auto uses remote_exec for python 3.14+ targets.')
 @click.option('-v', '--verbose', count=True)
 @click.option('-t', '--timeout', type=int, default=10)
 @click.option('-e', '--encoding', type=str, default='utf-8')
@@ -38,6 +205,9 @@ def main_entry(ctx, **kwargs):
 
 main_entry.add_command(inject)
 main_entry.add_command(shell)
+main_entry.add_command(exec_)
+main_entry.add_command(agent_group)
+main_entry.add_command(ps)
 
 
 def main():
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+
+"""
+Find, install and talk to resident agents in target processes.
+"""
+
+import os
+import stat
+import json
+import time
+import socket
+from pylane.core.procfs import ns_pid, ns_uid, find_python_object
+from pylane.core.delivery import process_uid
+from .sock import UnixSockClient, peer_pid
+from .inject import inject
+
+
+# per uid of target, only its owner can enter
+AGENT_DIR = '/tmp/pylane-agent-%s'
+INSTALL_TIMEOUT = 10
+
+# module and entrance of each kind of agent, async agent serves all clients
+# on one asyncio event loop, for python 3.5+ targets
+AGENTS = {
+    'thread': ('resident_agent', 'ResidentAgentThread'),
+    'async': ('async_agent', 'AsyncAgentThread'),
+}
+ASYNC_MIN_VERSION = (3, 5)
+
+
+def agent_path(pid, uid):
+    """agent socket path of target, reachable from our mount namespace"""
+    path = os.path.join(AGENT_DIR % ns_uid(pid, uid), '%s.sock' % ns_pid(pid))
+    root_path = '/proc/%d/root%s' % (pid, path)
+    return root_path if os.path.exists('/proc/%d/root' % pid) else path
+
+
+def private_dir(path, uid):
+    """if path is a dir, not a symlink, owned by uid and private to it"""
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    return stat.S_ISDIR(st.st_mode) and st.st_uid == uid and \
+        not st.st_mode & 0o077
+
+
+class AgentClient(object):
+    """Talk to the resident agent of a pid, one request a connection."""
+
+    def __init__(self, pid, encoding='utf-8'):
+        self.pid = pid
+        self.encoding = encoding
+        self.uid = process_uid(pid)
+        self.path = agent_path(pid, self.uid)
+
+    def request(self, *frames):
+        """
+        connect and send frames, returns connected sock,
+        raise socket.error if the sock is not served by target
+        """
+        if not private_dir(os.path.dirname(self.path), self.uid):
+            raise socket.error('agent dir of process %s is not private '
+                               'to its user' % self.pid)
+        sock = UnixSockClient(self.path, self.encoding, retries=1)
+        sock.connect()
+        if peer_pid(sock.sock) != self.pid:
+            sock.close()
+            raise socket.error('agent sock is not served by process %s'
+                               % self.pid)
+        for frame in frames:
+            sock.send(frame)
+        return sock
+
+    def call(self, *frames):
+        sock = self.request(*frames)
+        try:
+            return sock.recv()
+        finally:
+            sock.close()
+
+    def ping(self):
+        """Returns: dict: agent info, or None if agent not alive"""
+        if not os.path.exists(self.path):
+            return None
+        try:
+            return json.loads(self.call('ping'))
+        except (socket.error, ValueError, TypeError):
+            return None
+
+    def shell(self, stream=False):
+        """Returns: Transport: sock served by a remote shell thread"""
+        return self.request('shell', json.dumps({'stream': bool(stream)}))
+
+    def inject(self, code):
+        return self.call('inject', code) == 'ok'
+
+    def unload(self):
+        return self.call('unload') == 'ok'
+
+
+def find_agent(pid, encoding='utf-8'):
+    """Returns: AgentClient: alive agent of pid, or None"""
+    agent = AgentClient(pid, encoding)
+    return agent if agent.ping() else None
+
+
+def install_agent(inject_args, kind='thread'):
+    """
+    inject a resident agent and wait for its socket
+    Args:
+        kind (str): kind of agent in AGENTS
+    Returns:
+        AgentClient: agent client
+    """
+    pid = inject_args['pid']
+    if kind == 'async':
+        found = find_python_object(pid)
+        version = found and found[1]['version']
+        if version and tuple(version) < ASYNC_MIN_VERSION:
+            print('Async agent needs python %s.%s+, process %s runs %s.%s.'
+                  % (ASYNC_MIN_VERSION + (pid,) + tuple(version)))
+            exit(1)
+    module, entrance = AGENTS[kind]
+    inject(
+        module=module,
+        entrance=entrance,
+        inject_args=dict(inject_args))
+    deadline = time.time() + INSTALL_TIMEOUT
+    while time.time() < deadline:
+        agent = find_agent(pid, inject_args.get('encoding', 'utf-8'))
+        if agent:
+            return agent
+        time.sleep(0.05)
+    print('Agent of process %s not ready in %s seconds.' % (
+        pid, INSTALL_TIMEOUT))
+    exit(1)
+
+
+def connect_agent(inject_args, resident=False):
+    """
+    find agent of target, install one if resident
+    Returns:
+        AgentClient: agent client, or None
+    """
+    pid = inject_args['pid']
+    agent = find_agent(pid, inject_args.get('encoding', 'utf-8'))
+    if not agent and resident:
+        agent = install_agent(inject_args)
+    return agent
+
+
+def list_agents():
+    """
+    Returns:
+        list: [(pid, agent info)] of alive agents
+    """
+    agents = []
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        info = AgentClient(int(name)).ping()
+        if info:
+            agents.append((int(name), info))
+    return agents
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+
+"""
+Resident agent on a private asyncio event loop, one thread serves all
+clients with non-blocking io. Commands run in fixed pools of worker
+threads, threads in target do not grow with clients. Needs python 3.5+.
+"""
+
+import sys
+import json
+import zlib
+import socket
+import asyncio
+import threading
+import traceback
+import concurrent.futures
+
+from pylane.shell.sock import Transport, HEADER, FLAG_ZLIB, MSG_HELLO, \
+    BINARY_MESSAGES
+from pylane.shell.remote_shell import RemoteShellThread
+from pylane.shell.exec_runner import ExecRunnerThread
+from pylane.shell.resident_agent import ResidentAgentThread
+
+
+class LoopSocket(object):
+    """
+    Socket-like writer of a connection for shells and runners in worker
+    threads, writes by the event loop and waits for drain, so a slow client
+    never buffers unbounded output in target
+    """
+
+    SEND_TIMEOUT = 30
+
+    def __init__(self, loop, writer):
+        self.loop = loop
+        self.writer = writer
+        self.thread = threading.current_thread()
+
+    def sendall(self, data):
+        if threading.current_thread() is self.thread:
+            self.writer.write(data)
+            return
+        future = asyncio.run_coroutine_threadsafe(self.write(data), self.loop)
+        try:
+            future.result(self.SEND_TIMEOUT)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise socket.error('send timed out')
+
+    async def write(self, data):
+        self.writer.write(data)
+        await self.writer.drain()
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.writer.close)
+
+
+class AsyncAgentThread(ResidentAgentThread):
+    """
+    Stay in target process, serve shell, exec and inject requests of all
+    clients on one event loop.
+    """
+
+    # workers of shell commands and exec codes
+    WORKERS = 4
+    # workers of completion and help, never wait for running commands
+    QUICK_WORKERS = 2
+
+    def __init__(self, encoding='utf-8'):
+        """
+        """
+        super(AsyncAgentThread, self).__init__(encoding)
+        self.name = "pylane-async-agent-thread"
+        self.loop = None
+        self.stopped = None
+        self.workers = None
+        self.quick_workers = None
+
+    def info(self):
+        info = super(AsyncAgentThread, self).info()
+        info['kind'] = 'async'
+        return info
+
+    async def recv_message(self, reader):
+        """
+        Returns:
+            tuple: (msg_type, request_id, data), None if sock closed
+        """
+        try:
+            header = await reader.readexactly(HEADER.size)
+            length, msg_type, flags, request_id = HEADER.unpack(header)
+            data = await reader.readexactly(length)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return None
+        if flags & FLAG_ZLIB:
+            data = zlib.decompress(data)
+        if msg_type not in BINARY_MESSAGES:
+            data = data.decode(self.encoding)
+        return msg_type, request_id, data
+
+    async def recv(self, reader):
+        message = await self.recv_message(reader)
+        return message and message[2]
+
+    def run_in(self, workers, func, *args):
+        return self.loop.run_in_executor(workers, func, *args)
+
+    async def handle(self, reader, writer):
+        """
+        handle one request, shell request keeps connection
+        """
+        sock = LoopSocket(self.loop, writer)
+        transport = Transport(sock, self.encoding)
+        cmd = await self.recv(reader)
+        if cmd == 'ping':
+            transport.send(json.dumps(self.info()))
+        elif cmd == 'shell':
+            options = json.loads(await self.recv(reader) or '{}')
+            shell = await self.run_in(
+                self.workers, lambda: RemoteShellThread(
+                    encoding=self.encoding, sock=sock,
+                    stream=options.get('stream', False)))
+            await self.serve_shell(shell, reader)
+        elif cmd == 'exec':
+            code = await self.recv(reader)
+            runner = ExecRunnerThread(encoding=self.encoding, sock=sock)
+            if code:
+                result = await self.run_in(
+                    self.workers, runner.run_code, code)
+                transport.send(json.dumps(result))
+        elif cmd == 'inject':
+            code = await self.recv(reader)
+            # injected code may run forever, not in workers
+            thread = threading.Thread(target=self.exec_code, args=(code,))
+            thread.daemon = True
+            thread.start()
+            transport.send('ok')
+        elif cmd == 'unload':
+            self.running = False
+            transport.send('ok')
+            self.stopped.set()
+
+    async def serve_shell(self, shell, reader):
+        """
+        commands of a shell are run in order, concurrent requests beside
+        """
+        commands = asyncio.Queue()
+        worker = asyncio.ensure_future(self.run_commands(shell, commands))
+        try:
+            while not worker.done():
+                message = await self.recv_message(reader)
+                if message is None:
+                    break
+                msg_type, request_id, source = message
+                if msg_type == MSG_HELLO:
+                    shell.hello(source)
+                elif shell.is_concurrent(source):
+                    self.run_in(
+                        self.quick_workers, shell.serve, request_id, source)
+                else:
+                    commands.put_nowait((request_id, source))
+        finally:
+            commands.put_nowait(None)
+
+    async def run_commands(self, shell, commands):
+        while True:
+            command = await commands.get()
+            if command is None:
+                break
+            shell.request_id = command[0]
+            if not await self.run_in(self.workers, self.run_command,
+                                     shell, *command):
+                # exit() in a command ends the shell
+                shell.sock.close()
+                break
+
+    def run_command(self, shell, request_id, source):
+        """
+        Returns:
+            bool: False if command exits the shell
+        """
+        try:
+            shell.serve(request_id, source)
+        except SystemExit:
+            return False
+        return True
+
+    async def serve(self, reader, writer):
+        try:
+            await self.handle(reader, writer)
+        except asyncio.CancelledError:
+            # a BaseException since python 3.8, connections left are
+            # cancelled on unload, close them quietly
+            pass
+        except Exception:
+            traceback.print_exc(file=sys.__stderr__)
+        finally:
+            writer.close()
+
+    async def serve_forever(self):
+        self.stopped = asyncio.Event()
+        server = await asyncio.start_unix_server(self.serve, sock=self.server)
+        await self.stopped.wait()
+        server.close()
+        # drop connections left, shells and runners see their sock closed
+        all_tasks = getattr(asyncio, 'all_tasks', None) or \
+            asyncio.Task.all_tasks
+        current_task = getattr(asyncio, 'current_task', None) or \
+            asyncio.Task.current_task
+        current = current_task()
+        tasks = [task for task in all_tasks() if task is not current]
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.wait(tasks)
+
+    def unload(self):
+        for workers in (self.workers, self.quick_workers):
+            if workers:
+                workers.shutdown(wait=False)
+        super(AsyncAgentThread, self).unload()
+
+    def run(self):
+        """
+        main run entrance
+        """
+        try:
+            self.listen()
+            self.loop = asyncio.new_event_loop()
+            self.workers = concurrent.futures.ThreadPoolExecutor(
+                self.WORKERS)
+            self.quick_workers = concurrent.futures.ThreadPoolExecutor(
+                self.QUICK_WORKERS)
+            self.loop.run_until_complete(self.serve_forever())
+        except:
+            traceback.print_exc(file=sys.__stderr__)
+        finally:
+            self.unload()
+            if self.loop:
+                self.loop.close()
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+
+"""
+Caches of remote completion, names of an object are listed by dir once
+and looked up by prefix until the object changes.
+"""
+
+import bisect
+import inspect
+import threading
+
+
+# attribute lists of children sent along with their parent
+PREFETCH_COUNT = 20
+PREFETCH_NAMES = 500
+
+
+def version(obj):
+    """
+    Returns:
+        tuple: changes when obj is replaced or attributes added or removed
+    """
+    try:
+        size = len(obj.__dict__)
+    except Exception:
+        size = -1
+    return id(obj), type(obj), size
+
+
+def static_getattr(obj, name):
+    """
+    get attribute without running properties, descriptors or __getattr__
+    of obj, raise AttributeError on python 2 or a descriptor found
+    """
+    getattr_static = getattr(inspect, 'getattr_static', None)
+    if getattr_static is None:
+        raise AttributeError(name)
+    value = getattr_static(obj, name)
+    if not isinstance(value, type) and hasattr(type(value), '__get__'):
+        raise AttributeError(name)
+    return value
+
+
+def split_text(text):
+    """
+    Returns:
+        tuple: (item to list names of, '' for namespace, prefix of name)
+    """
+    if '.' not in text:
+        return '', text
+    return tuple(text.rsplit('.', 1))
+
+
+class CompletionCache(object):
+    """
+    Sorted names of evaluated items in target, revalidated by version
+    """
+
+    SIZE = 256
+
+    def __init__(self, size=None):
+        self.size = size or self.SIZE
+        self.entries = {}
+        # children prefetched in background, sent with next names
+        self.prefetched = {}
+        self.prefetching = None
+
+    def names(self, item, obj):
+        """
+        Returns:
+            list: sorted attribute names of obj
+        """
+        key = version(obj)
+        entry = self.entries.get(item)
+        if entry and entry[0] == key:
+            return entry[1]
+        names = sorted(dir(obj))
+        if len(self.entries) >= self.size:
+            self.entries.clear()
+        self.entries[item] = (key, names)
+        return names
+
+    def namespace(self, namespace):
+        """names of interpreter namespace, cached by its size"""
+        key = (id(namespace), dict, len(namespace))
+        entry = self.entries.get('')
+        if entry and entry[0] == key:
+            return entry[1]
+        names = sorted(namespace)
+        self.entries[''] = (key, names)
+        return names
+
+    def children(self, item, names, get):
+        """
+        prefetch names of attributes likely to be completed next,
+        modules, classes and objects with attributes
+        Args:
+            get (callable): get a child by name, without side effects
+        Returns:
+            dict: {child item: sorted names}
+        """
+        children = {}
+        for name in names:
+            if len(children) >= PREFETCH_COUNT:
+                break
+            if name.startswith('_'):
+                continue
+            try:
+                child = get(name)
+            except Exception:
+                continue
+            if not hasattr(child, '__dict__') or callable(child) and \
+                    not isinstance(child, type):
+                continue
+            child_item = '%s.%s' % (item, name) if item else name
+            child_names = self.names(child_item, child)
+            if len(child_names) <= PREFETCH_NAMES:
+                children[child_item] = child_names
+        return children
+
+    def prefetch(self, item, names, get):
+        """prefetch children in a background thread, one at a time"""
+        if self.prefetching and self.prefetching.is_alive():
+            return
+        self.prefetching = threading.Thread(
+            target=self._prefetch, args=(item, names, get),
+            name='pylane-completion-prefetch')
+        self.prefetching.daemon = True
+        self.prefetching.start()
+
+    def _prefetch(self, item, names, get):
+        try:
+            self.prefetched.update(self.children(item, names, get))
+        except Exception:
+            pass
+
+    def take_prefetched(self):
+        """
+        Returns:
+            dict: {child item: sorted names} prefetched since last take
+        """
+        prefetched = {}
+        for child_item in list(self.prefetched):
+            prefetched[child_item] = self.prefetched.pop(child_item)
+        return prefetched
+
+
+def startswith(names, prefix):
+    """names in sorted names starting with prefix"""
+    start = bisect.bisect_left(names, prefix)
+    end = start
+    while end < len(names) and names[end].startswith(prefix):
+        end += 1
+    return names[start:end]
+
+
+class PrefixTrie(object):
+    """
+    Names indexed by prefix, for client side lookup on each key press
+    """
+
+    END = ''
+
+    def __init__(self, names=()):
+        self.root = {}
+        for name in names:
+            self.add(name)
+
+    def add(self, name):
+        node = self.root
+        for char in name:
+            node = node.setdefault(char, {})
+        node[self.END] = name
+
+    def find(self, prefix):
+        """
+        Returns:
+            list: sorted names starting with prefix
+        """
+        node = self.root
+        for char in prefix:
+            node = node.get(char)
+            if node is None:
+                return []
+        names = []
+        nodes = [node]
+        while nodes:
+            node = nodes.pop()
+            for char, child in node.items():
+                if char == self.END:
+                    names.append(child)
+                else:
+                    nodes.append(child)
+        return sorted(names)
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+import ast
+import sys
+import json
+import time
+import threading
+import traceback
+
+from pylane.shell.sock import SockClient, UnixSockClient, Transport
+from pylane.shell.remote_shell import OutputHookContext
+
+
+class ExecRunnerThread(threading.Thread):
+    """
+    Start a thread in target process, run one code and send back
+    its stdout, stderr, value of the last expression and exception.
+    """
+
+    def __init__(self, host=None, port=None, encoding='utf-8', sock=None,
+                 path=None):
+        """
+        connect to unix socket path or host:port, or serve on an accepted sock
+        """
+        self.encoding = encoding
+        self.stdio_hook = OutputHookContext()
+        if sock:
+            self.sock = Transport(sock, encoding)
+        elif path:
+            self.sock = UnixSockClient(path, encoding)
+        else:
+            self.sock = SockClient(host, port, encoding)
+        super(ExecRunnerThread, self).__init__()
+        self.daemon = True
+        self.name = "pylane-exec-thread"
+
+    def run_code(self, code):
+        """
+        run code, eval its last expression
+        Returns:
+            dict: stdout, stderr, value, error and duration
+        """
+        import __main__ as main
+        namespace = {'__name__': '__pylane_exec__', 'main': main, 'sys': sys}
+        value = error = None
+        start = time.time()
+        with self.stdio_hook:
+            try:
+                tree = ast.parse(code, '<pylane-exec>', 'exec')
+                last = None
+                if tree.body and isinstance(tree.body[-1], ast.Expr):
+                    last = ast.Expression(tree.body.pop().value)
+                exec(compile(tree, '<pylane-exec>', 'exec'), namespace)
+                if last is not None:
+                    result = eval(
+                        compile(last, '<pylane-exec>', 'eval'), namespace)
+                    # a failing __repr__ is reported as an error of code
+                    if result is not None:
+                        value = repr(result)
+            except:
+                # skip frame of run_code itself
+                etype, e, tb = sys.exc_info()
+                error = ''.join(
+                    traceback.format_exception(etype, e, tb.tb_next))
+            out, err = self.stdio_hook.getvalue_truncate()
+        return {
+            'stdout': out,
+            'stderr': err,
+            'value': value,
+            'error': error,
+            'duration': time.time() - start,
+        }
+
+    def run(self):
+        """
+        main run entrance
+        """
+        try:
+            if self.sock.sock is None:
+                self.sock.connect()
+            code = self.sock.recv()
+            if code:
+                self.sock.send(json.dumps(self.run_code(code)))
+        except:
+            traceback.print_exc(file=sys.__stderr__)
+        finally:
+            self.sock.close()
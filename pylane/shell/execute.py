@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+"""
+Run code in target without a shell, get its output, value and exception.
+"""
+
+import sys
+import json
+import socket
+from pylane.core.exception import PylaneExceptionHandler, PylaneException
+from .server import AsyncServer
+from .inject import inject
+from .agent import find_agent
+
+
+EXIT_OK = 0
+EXIT_ERROR = 1
+EXIT_TIMEOUT = 2
+
+
+class Executor(AsyncServer):
+    """Inject a one-shot runner, send code and wait for its result."""
+
+    MODULE = 'exec_runner'
+    ENTRANCE = 'ExecRunnerThread'
+
+    def __init__(self, inject_args, call_timeout=30):
+        """
+        Args:
+            inject_args (dict): args of Injector.
+            call_timeout (int): seconds to wait for result of code.
+        """
+        self.inject_args = inject_args
+        self.call_timeout = call_timeout
+
+    def connect(self):
+        """connect a runner in target, by resident agent if exists"""
+        agent = find_agent(
+            self.inject_args['pid'], self.inject_args.get('encoding'))
+        if agent:
+            return agent.request('exec')
+        address = self.start_server(
+            encoding=self.inject_args.get('encoding'),
+            timeout=self.inject_args.get('timeout'),
+            pid=self.inject_args['pid']
+        )
+        inject(
+            module=self.MODULE,
+            entrance=self.ENTRANCE,
+            inject_args=self.inject_args,
+            **address)
+        self.wait()
+        return self.sock
+
+    def run(self, code):
+        """
+        Returns:
+            dict: stdout, stderr, value, error and duration, None if timeout
+        """
+        sock = self.connect()
+        try:
+            sock.sock.settimeout(self.call_timeout or None)
+            sock.send(code)
+            raw = sock.recv()
+        except socket.timeout:
+            return None
+        finally:
+            sock.close()
+        if not raw:
+            raise PylaneException(
+                'Connection closed by target before the result was sent.')
+        return json.loads(raw)
+
+
+@PylaneExceptionHandler
+def execute(code, as_json=False, call_timeout=30, **inject_args):
+    """
+    Returns:
+        int: exit status, EXIT_OK, EXIT_ERROR or EXIT_TIMEOUT
+    """
+    result = Executor(inject_args, call_timeout).run(code)
+    if result is None:
+        if as_json:
+            print(json.dumps({'error': 'timeout'}))
+        else:
+            sys.stderr.write(
+                'No result in %s seconds, code is still running in target.\n'
+                % call_timeout)
+        return EXIT_TIMEOUT
+    if as_json:
+        print(json.dumps(result))
+    else:
+        sys.stdout.write(result['stdout'])
+        sys.stderr.write(result['stderr'])
+        if result['value'] is not None:
+            print(result['value'])
+        if result['error']:
+            sys.stderr.write(result['error'])
+    return EXIT_ERROR if result['error'] else EXIT_OK
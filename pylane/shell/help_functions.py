@@ -11,34 +11,34 @@ Use remote ipc to inject, don't import them in remote process in case of reload.
 from __future__ import print_function
 
 
-def get_insts(class_name):
-    """get_insts(class_name) -> instance_list"""
+def get_insts(class_name, budget=None):
+    """get_insts(class_name, budget=None) -> instance_list : heap is scanned in slices of budget seconds, see heap_scan"""
     ins_list = []
-    import gc
-    for obj in gc.get_objects():
-        try:
-            if getattr(obj, "__class__", None):
-                if obj.__class__.__name__ == class_name:
-                    ins_list.append(obj)
-        # weak ref items will raise an exc here
-        except ReferenceError:
-            continue
+    for objects in HeapScan(budget):
+        for obj in objects:
+            try:
+                if getattr(obj, "__class__", None):
+                    if obj.__class__.__name__ == class_name:
+                        ins_list.append(obj)
+            # weak ref items will raise an exc here
+            except ReferenceError:
+                continue
     return ins_list
 
 
-def get_classes(class_name):
-    """get_classes(class_name) -> class_object_list : cast new type class only"""
+def get_classes(class_name, budget=None):
+    """get_classes(class_name, budget=None) -> class_object_list : cast new type class only"""
     cls_list = []
-    import gc
     import inspect
-    for obj in gc.get_objects():
-        try:
-            if getattr(obj, "__class__", None):
-                if inspect.isclass(obj) and obj.__name__ == class_name:
-                    cls_list.append(obj)
-        # weak ref items will raise an exc here
-        except ReferenceError:
-            continue
+    for objects in HeapScan(budget):
+        for obj in objects:
+            try:
+                if getattr(obj, "__class__", None):
+                    if inspect.isclass(obj) and obj.__name__ == class_name:
+                        cls_list.append(obj)
+            # weak ref items will raise an exc here
+            except ReferenceError:
+                continue
     return cls_list
 
 
@@ -114,3 +114,502 @@ def log_it(func):
         ))
         return ret
     return wrapper
+
+
+class HeapScan(object):
+    """HeapScan : iterate gc tracked objects, or a list of objects, in slices, each slice is processed in about budget seconds, sleep pause seconds between slices for other threads to take the GIL"""
+
+    # seconds a slice may hold the GIL, as sys switch interval
+    BUDGET = 0.005
+    PAUSE = 0.001
+    MIN_SLICE = 100
+    PROGRESS_INTERVAL = 1
+
+    def __init__(self, budget=None, pause=None, progress=False,
+                 objects=None):
+        self.budget = self.BUDGET if budget is None else budget
+        self.pause = self.PAUSE if pause is None else pause
+        self.progress = progress
+        self.objects = objects
+        self.done = 0
+        self.total = 0
+
+    def __iter__(self):
+        import gc
+        import time
+        objects = gc.get_objects() if self.objects is None else self.objects
+        self.total = len(objects)
+        self.done = 0
+        if not self.budget:
+            # one slice, no pause
+            self.done = self.total
+            yield objects
+            return
+        size = self.MIN_SLICE
+        reported = time.time()
+        while self.done < self.total:
+            start = time.time()
+            yield objects[self.done:self.done + size]
+            elapsed = time.time() - start
+            self.done = min(self.done + size, self.total)
+            # size next slice by speed of this one, grow slowly
+            size = max(self.MIN_SLICE, min(
+                size * 2, int(size * self.budget / max(elapsed, 1e-6))))
+            if self.progress and \
+                    time.time() - reported >= self.PROGRESS_INTERVAL:
+                reported = time.time()
+                print(self)
+            if self.done < self.total:
+                time.sleep(self.pause)
+        if self.progress:
+            print(self)
+
+    def __repr__(self):
+        return '<HeapScan %d/%d objects (%d%%)>' % (
+            self.done, self.total, 100 * self.done // max(self.total, 1))
+
+
+def heap_scan(budget=None, pause=None, progress=False):
+    """heap_scan(budget=0.005, pause=0.001, progress=False) -> HeapScan : for objects in heap_scan(): ..., walk heap in slices without stalling other threads, budget 0 walks in one slice"""
+    return HeapScan(budget, pause, progress)
+
+
+class HeapSnapshot(object):
+    """HeapSnapshot : count and shallow size of gc tracked objects by type name, with an index of instances, built by snapshot()"""
+
+    # Py_TPFLAGS_HEAPTYPE, classes defined by python code
+    HEAP_TYPE = 1 << 9
+
+    def __init__(self, budget=None, index=True):
+        self.budget = budget
+        self.index = index
+        self.refresh()
+
+    def refresh(self):
+        """refresh() -> HeapSnapshot : walk the heap again, rebuild the index"""
+        import sys
+        import time
+        import weakref
+        import itertools
+        import collections
+        from array import array
+        start = time.time()
+        getsizeof = sys.getsizeof
+        counts = collections.Counter()
+        sizes = collections.Counter()
+        # weak refs of instances of python classes and of classes, others
+        # like dict are only counted
+        indexed = set()
+        refs = collections.defaultdict(list)
+        for objects in HeapScan(self.budget):
+            # iterate in c by map and compress, a python loop over all
+            # objects costs several times more
+            slice_counts = collections.Counter(map(type, objects))
+            for cls in slice_counts:
+                if self.index and cls not in counts and \
+                        cls.__weakrefoffset__ and (
+                            cls.__flags__ & self.HEAP_TYPE or
+                            issubclass(cls, type)):
+                    indexed.add(cls)
+            counts.update(slice_counts)
+            for obj in objects:
+                try:
+                    sizes[type(obj)] += getsizeof(obj)
+                except Exception:
+                    continue
+            selected = list(itertools.compress(
+                objects, map(indexed.__contains__, map(type, objects))))
+            for cls, ref in zip(map(type, selected),
+                                map(weakref.ref, selected)):
+                refs[cls].append(ref)
+        # types of the same name are merged, as get_insts matches by name,
+        # counts and sizes are kept in arrays by sorted names, so that
+        # snapshots kept for heap_diff cost little
+        by_name = collections.defaultdict(list)
+        for cls in counts:
+            by_name[cls.__name__].append(cls)
+        self.type_names = sorted(by_name)
+        self.counts = array('L', (
+            sum(counts[cls] for cls in by_name[name])
+            for name in self.type_names))
+        self.sizes = array('L', (
+            sum(sizes[cls] for cls in by_name[name])
+            for name in self.type_names))
+        self.types = {}
+        self.refs = {}
+        self.class_refs = {}
+        for name, classes in by_name.items():
+            self.types[name] = [weakref.ref(cls) for cls in classes]
+            if not all(cls in indexed for cls in classes):
+                # None refs if any of them is not indexed
+                self.refs[name] = None
+                continue
+            self.refs[name] = [ref for cls in classes for ref in refs[cls]]
+            for cls in classes:
+                if not issubclass(cls, type):
+                    continue
+                for ref in refs[cls]:
+                    obj = ref()
+                    if obj is not None:
+                        self.class_refs.setdefault(
+                            obj.__name__, []).append(ref)
+        self.time = time.time()
+        self.duration = self.time - start
+        return self
+
+    def position(self, type_name):
+        import bisect
+        i = bisect.bisect_left(self.type_names, type_name)
+        if i < len(self.type_names) and self.type_names[i] == type_name:
+            return i
+        return None
+
+    def names(self):
+        """names() -> type_name_list"""
+        return list(self.type_names)
+
+    def count(self, type_name):
+        """count(type_name) -> count of objects when snapshot taken"""
+        i = self.position(type_name)
+        return 0 if i is None else self.counts[i]
+
+    def size(self, type_name):
+        """size(type_name) -> shallow size in bytes of objects when snapshot taken"""
+        i = self.position(type_name)
+        return 0 if i is None else self.sizes[i]
+
+    def top(self, n=20, sort='size'):
+        """top(n=20, sort='size') -> [(type_name, count, size)] : most common types by count or size"""
+        rows = list(zip(self.type_names, self.counts, self.sizes))
+        rows.sort(key=lambda row: row[1] if sort == 'count' else row[2],
+                  reverse=True)
+        return rows[:n]
+
+    def insts(self, type_name):
+        """insts(type_name) -> instance_list : alive ones, objects of builtin types like dict are found by a walk"""
+        refs = self.refs.get(type_name, [])
+        if refs is not None:
+            return [obj for obj in (ref() for ref in refs) if obj is not None]
+        import itertools
+        types = set(ref() for ref in self.types[type_name])
+        insts = []
+        for objects in HeapScan(self.budget):
+            insts.extend(itertools.compress(
+                objects, map(types.__contains__, map(type, objects))))
+        return insts
+
+    def classes(self, class_name):
+        """classes(class_name) -> class_object_list"""
+        if not self.index:
+            return get_classes(class_name, self.budget)
+        refs = self.class_refs.get(class_name, [])
+        return [cls for cls in (ref() for ref in refs) if cls is not None]
+
+    def filter(self, type_name, func):
+        """filter(type_name, func) -> instance_list : instances func returns true for, errors of func are skipped"""
+        matched = []
+        for obj in self.insts(type_name):
+            try:
+                if func(obj):
+                    matched.append(obj)
+            except Exception:
+                continue
+        return matched
+
+    def __repr__(self):
+        return '<HeapSnapshot %d objects, %d types, %d bytes, took %.3fs>' \
+            % (sum(self.counts), len(self.type_names), sum(self.sizes),
+               self.duration)
+
+
+def snapshot(budget=None, index=True):
+    """snapshot(budget=None, index=True) -> HeapSnapshot : index heap by type name in one walk by heap_scan, then .insts(name), .classes(name), .count(name), .top(), .filter(name, func) run without walking again, .refresh() to rebuild, index=False only counts for heap_diff"""
+    return HeapSnapshot(budget, index)
+
+
+def print_table(headers, rows):
+    """print_table(headers, rows) -> None : print rows aligned, first column left, others right"""
+    widths = [len(header) for header in headers]
+    rows = [[str(cell) for cell in row] for row in rows]
+    for row in rows:
+        widths = [max(width, len(cell)) for width, cell in zip(widths, row)]
+    line_format = '  '.join(
+        ['%%-%ds' % widths[0]] + ['%%%ds' % width for width in widths[1:]])
+    print(line_format % tuple(headers))
+    for row in rows:
+        print(line_format % tuple(row))
+
+
+def heap_histogram(top=20, sort='size', budget=None):
+    """heap_histogram(top=20, sort='size') -> HeapSnapshot : print count and shallow size of top types by size or count, keep the snapshot for heap_diff"""
+    snap = HeapSnapshot(budget, index=False)
+    print_table(('TYPE', 'COUNT', 'SIZE'), snap.top(top, sort))
+    print('total %d objects, %d bytes' % (sum(snap.counts), sum(snap.sizes)))
+    return snap
+
+
+def heap_diff(a, b=None, top=20, sort='size'):
+    """heap_diff(a, b=None, top=20, sort='size') -> None : print types growing most from snapshot a to b by size or count, b is taken now if not given"""
+    if b is None:
+        b = HeapSnapshot(a.budget, index=False)
+    rows = []
+    for name in sorted(set(a.type_names) | set(b.type_names)):
+        count, size = b.count(name), b.size(name)
+        rows.append((name, count, count - a.count(name),
+                     size, size - a.size(name)))
+    rows.sort(key=lambda row: row[2] if sort == 'count' else row[4],
+              reverse=True)
+    print_table(('TYPE', 'COUNT', '+COUNT', 'SIZE', '+SIZE'), [
+        row[:2] + ('%+d' % row[2], row[3], '%+d' % row[4])
+        for row in rows[:top]])
+    print('%.0f seconds between snapshots' % (b.time - a.time))
+
+
+def describe_ref(referrer, obj):
+    """describe_ref(referrer, obj) -> string : how referrer refers to obj, like ['key'], [3] or .attr"""
+    import types
+    try:
+        if isinstance(referrer, dict):
+            for key, value in referrer.items():
+                if value is obj:
+                    return '[%r]' % (key,)
+                if key is obj:
+                    return 'key %r' % (key,)
+        elif isinstance(referrer, (list, tuple)):
+            for i, value in enumerate(referrer):
+                if value is obj:
+                    return '[%d]' % i
+        elif isinstance(referrer, types.FrameType):
+            for name, value in referrer.f_locals.items():
+                if value is obj:
+                    return 'local %s' % name
+        if getattr(referrer, '__dict__', None) is obj:
+            return '.__dict__'
+        for name in ('__self__', '__func__', '__globals__', '__closure__',
+                     'cell_contents', 'f_back', 'gi_frame', '__class__'):
+            if getattr(referrer, name, None) is obj:
+                return '.' + name
+    except Exception:
+        pass
+    return '->'
+
+
+def retention_path(obj, max_depth=20, max_nodes=1000000, budget=None):
+    """retention_path(obj, max_depth=20, max_nodes=1000000) -> path_line_list : shortest chain of references from a module or a frame of another thread to obj, by BFS over a referrer index built in one heap scan, None if not found in max_depth hops or max_nodes objects"""
+    import gc
+    import sys
+    import types
+    import threading
+    # referrer of each gc tracked object, most have only one, others are
+    # kept in lists of more
+    first = {}
+    more = {}
+    # frames of this thread and namespace of shell refer to obj as well
+    ignore = set([id(first), id(more)])
+    frame = sys._getframe()
+    module_dicts = set(id(getattr(m, '__dict__', None))
+                       for m in list(sys.modules.values()))
+    while frame is not None:
+        ignore.add(id(frame))
+        if id(frame.f_globals) not in module_dicts:
+            ignore.add(id(frame.f_globals))
+        frame = frame.f_back
+    scan = iter(HeapScan(budget))
+    ignore.add(id(getattr(scan, 'gi_frame', None)))
+    is_tracked = gc.is_tracked
+    get_referents = gc.get_referents
+    target = id(obj)
+    objects = None
+    for objects in scan:
+        for referrer in objects:
+            if id(referrer) in ignore:
+                continue
+            for referent in get_referents(referrer):
+                key = id(referent)
+                if key != target and not is_tracked(referent):
+                    continue
+                if key not in first:
+                    first[key] = referrer
+                else:
+                    more.setdefault(key, []).append(referrer)
+    del objects
+
+    roots = {}
+    for module in list(sys.modules.values()):
+        if module is not None:
+            roots[id(module)] = 'module %s' % module.__name__
+    names = dict((thread.ident, thread.name)
+                 for thread in threading.enumerate())
+    for ident, frame in sys._current_frames().items():
+        if ident == threading.current_thread().ident:
+            continue
+        while frame is not None:
+            roots[id(frame)] = 'thread %s frame %s %s:%d' % (
+                names.get(ident, ident), frame.f_code.co_name,
+                frame.f_code.co_filename, frame.f_lineno)
+            # locals of running frames are not always referents of frame
+            for value in frame.f_locals.values():
+                key = id(value)
+                if key not in first:
+                    first[key] = frame
+                elif first[key] is not frame:
+                    more.setdefault(key, []).append(frame)
+            frame = frame.f_back
+    del frame
+
+    def describe(node):
+        if id(node) in roots:
+            return roots[id(node)]
+        return type(node).__name__
+
+    def from_shell(node):
+        module = getattr(type(node), '__module__', None) or ''
+        return module.startswith(('pylane', '__pylane'))
+
+    # BFS from obj toward roots, nexts maps a referrer to the object it
+    # refers to on the way to obj
+    nexts = {target: None}
+    level = [obj]
+    found = None
+    for depth in range(max_depth):
+        if target in roots:
+            found = obj
+            break
+        next_level = []
+        for node in level:
+            referrers = [first.get(id(node))] + more.get(id(node), [])
+            for referrer in referrers:
+                if referrer is None or id(referrer) in nexts or \
+                        id(referrer) in ignore or from_shell(referrer) or \
+                        isinstance(referrer, types.FrameType) and \
+                        id(referrer) not in roots:
+                    continue
+                nexts[id(referrer)] = node
+                if id(referrer) in roots:
+                    found = referrer
+                    break
+                next_level.append(referrer)
+            if found is not None or len(nexts) >= max_nodes:
+                break
+        if found is not None or len(nexts) >= max_nodes or not next_level:
+            break
+        level = next_level
+    if found is None:
+        return None
+    lines = [describe(found)]
+    node = found
+    while id(node) != target:
+        child = nexts[id(node)]
+        lines.append('%s %s' % (describe_ref(node, child), describe(child)))
+        node = child
+    return lines
+
+
+def print_retention_path(obj, max_depth=20, max_nodes=1000000, budget=None):
+    """print_retention_path(obj, max_depth=20, max_nodes=1000000) -> None : print shortest chain of references keeping obj alive"""
+    lines = retention_path(obj, max_depth, max_nodes, budget)
+    if lines is None:
+        print('No path from a module or another thread in %s hops.' % (
+            max_depth))
+        return
+    for i, line in enumerate(lines):
+        print('  ' * min(i, 1) + line)
+
+
+def deep_sizeof(obj, exclude_types=(), max_objects=100000, sample=None,
+                top=20, budget=None):
+    """deep_sizeof(obj, exclude_types=(), max_objects=100000, sample=None, top=20, budget=None) -> {type_name: (count, size)} : print size of obj and all objects it refers to by type, modules and classes are shared and skipped, containers longer than sample are estimated from sample entries, walked in slices like heap_scan"""
+    import gc
+    import sys
+    import types
+    import itertools
+    import collections
+    skip = (types.ModuleType, type) + tuple(exclude_types)
+    containers = set((list, tuple, dict, set, frozenset))
+    # module dicts are shared as well, taken as seen
+    seen = set(id(getattr(module, '__dict__', None))
+               for module in list(sys.modules.values()))
+    seen.add(id(obj))
+    walked = {}
+    counts = collections.Counter()
+    sizes = collections.Counter()
+    total = 0
+    sampled = False
+    stopped = False
+
+    def admit(weight, referents):
+        # drop objects seen or of skipped types, queue others, referents of
+        # a large container are many, take them in slices as well
+        for objects in HeapScan(budget, objects=referents):
+            fresh = dict(zip(map(id, objects), objects))
+            keys = getattr(fresh, 'viewkeys', fresh.keys)() - seen
+            seen.update(keys)
+            objects = list(map(fresh.__getitem__, keys))
+            for cls in set(map(type, objects)) - set(walked):
+                walked[cls] = not issubclass(cls, skip)
+            next_level[weight].extend(itertools.compress(
+                objects, map(walked.__getitem__, map(type, objects))))
+
+    # walk a level of referents at a time, in slices of about budget
+    # seconds, most work in c by map and compress, objects are grouped by
+    # weight, how many objects one stands for under sampled containers
+    level = {1: [obj]}
+    while level and not stopped:
+        next_level = collections.defaultdict(list)
+        for weight, objects in level.items():
+            if total + len(objects) > max_objects:
+                objects = objects[:max_objects - total]
+                stopped = True
+            total += len(objects)
+            for chunk in HeapScan(budget, objects=objects):
+                for cls, size in zip(map(type, chunk), map(
+                        sys.getsizeof, chunk, itertools.repeat(0))):
+                    counts[cls] += weight
+                    sizes[cls] += size * weight
+                if sample:
+                    large = [o for o in itertools.compress(chunk, map(
+                        containers.__contains__, map(type, chunk)))
+                        if len(o) > sample]
+                    if large:
+                        sampled = True
+                        large_ids = set(map(id, large))
+                        chunk = [o for o in chunk if id(o) not in large_ids]
+                    for o in large:
+                        length = len(o)
+                        if isinstance(o, (list, tuple)):
+                            entries = [o[i * length // sample]
+                                       for i in range(sample)]
+                        elif isinstance(o, dict):
+                            items = getattr(o, 'iteritems', o.items)()
+                            entries = list(itertools.chain.from_iterable(
+                                itertools.islice(items, sample)))
+                        else:
+                            entries = list(itertools.islice(o, sample))
+                        admit(weight * float(length) / sample, entries)
+                if chunk:
+                    # dicts of str keys do not report their keys as
+                    # referents on newer pythons
+                    admit(weight, gc.get_referents(*chunk) + list(
+                        itertools.chain.from_iterable(
+                            o for o in chunk if isinstance(o, dict))))
+        if stopped:
+            break
+        level = dict(
+            (weight, objects) for weight, objects in next_level.items()
+            if objects)
+    # types of the same name are merged, like in heap_histogram
+    breakdown = {}
+    for cls in counts:
+        (count, size) = breakdown.get(cls.__name__, (0, 0))
+        breakdown[cls.__name__] = (
+            count + int(counts[cls]), size + int(sizes[cls]))
+    rows = sorted(((name,) + breakdown[name] for name in breakdown),
+                  key=lambda row: row[2], reverse=True)
+    print_table(('TYPE', 'COUNT', 'SIZE'), rows[:top])
+    print('total %d objects, %d bytes%s' % (
+        sum(row[1] for row in rows), sum(row[2] for row in rows),
+        ', estimated from samples' if sampled else ''))
+    if stopped:
+        print('Stopped at %d objects, raise max_objects or set sample.' % (
+            max_objects))
+    return breakdown
@@ -2,38 +2,49 @@
 
 import os
 from pylane.core.injector import inject as _inject
+from .timing import Timing
 
 
-def inject(module, entrance, host, port, inject_args):
+def inject(module, entrance, inject_args, timing=None, **entrance_args):
     """
     inject process with module.entrance
+    Args:
+        timing (Timing): record durations of payload and attach steps
     """
-    encoding = inject_args.get('encoding', 'utf-8')
-    code = create_payload(module, entrance, host, port, encoding)
+    timing = timing or Timing()
+    entrance_args.setdefault('encoding', inject_args.get('encoding', 'utf-8'))
+    with timing.step('payload'):
+        code, stub = create_payload(module, entrance, **entrance_args)
     inject_args['code'] = code
-    success = _inject(**inject_args)
+    inject_args['stub'] = stub
+    with timing.step('attach'):
+        success = _inject(**inject_args)
     if not success:
         exit(1)
 
 
-def create_payload(module, entrance, host, port, encoding):
+def module_body(module):
     """
-    generate inject payload code for an exist file
+    code of a module in this package indented into a function body,
+    compiled code of the payload is cached on disk by the injector
     """
     base_path = os.path.dirname(os.path.abspath(__file__))
     file_path = base_path + '/%s.py' % module
-
-    payload = "def start_remote_shell():\n"
     with open(file_path) as f:
-        for line in f.readlines():
-            if line.startswith('#'):
-                continue
-            payload += '    ' + line
-    payload += "\n    {entrance}(host='{host}', port={port}, encoding='{encoding}').start()\n".format(
-        entrance=entrance,
-        host=host,
-        port=port,
-        encoding=encoding
+        return ''.join(
+            '    ' + line for line in f if not line.startswith('#'))
+
+
+def create_payload(module, entrance, **entrance_args):
+    """
+    generate inject payload code for an exist file
+    Returns:
+        tuple: (payload code, same for a module and cached compiled,
+            stub code starting it with entrance args)
+    """
+    payload = "def start_remote_shell(entrance_args):\n" + module_body(module)
+    payload += "\n    {entrance}(**entrance_args).start()\n".format(
+        entrance=entrance
     )
-    payload += '\nstart_remote_shell()'
-    return payload
+    stub = 'start_remote_shell(%r)' % (entrance_args,)
+    return payload, stub
@@ -1,8 +1,14 @@
 # -*- coding: utf-8 -*-
 
+import sys
 import json
+import itertools
+import threading
 from IPython.terminal.embed import InteractiveShellEmbed
 from IPython.core.interactiveshell import ExecutionResult
+from .sock import MSG_REQUEST, MSG_CHUNK, MSG_VALUE, MSG_HELLO
+from . import values
+from .completion import PrefixTrie, split_text
 
 
 class IPythonShell(InteractiveShellEmbed):
@@ -14,6 +20,12 @@ class IPythonShell(InteractiveShellEmbed):
         InteractiveShellEmbed.__init__(self)
         self.set_custom_completer(self.remote_completer, pos=0)
         self.encoding = encoding or self.ENCODING
+        self.request_ids = itertools.count(1)
+        self.request_lock = threading.Lock()
+        self.register_magic_function(self.expand_magic, 'line', 'expand')
+        # names of remote items, cleared after each command
+        self.completion_names = {}
+        self.completion_tries = {}
 
     def ipython_pre_works(self, result, raw_cell, store_history,
                           silent=False, shell_futures=True,
@@ -88,30 +100,38 @@ class IPythonShell(InteractiveShellEmbed):
             result, raw_cell, store_history, silent, shell_futures
         )
 
-        output = self._runsource(cell)
-        if output:
+        output, value = self.request(cell)
+        self.clear_completions()
+        if value is not None:
+            result.result = value
+        elif output:
             result.result = output
-            self._output(output)
-            # self.write(output)
+        self._output(output, value)
         self.ipython_post_works(result, store_history)
 
         return result
 
-    def _output(self, output):
+    def expand_magic(self, line):
         """
-        try to display evaled object
-        if failed, write raw string
+        %expand HANDLE_ID: fetch all items or attributes of a remote handle
         """
-        try:
-            output = eval(output)
-            try:
-                output = output.decode(self.encoding)
-            except:
-                pass
-            self.displayhook(output)
+        handle_id = line.strip().lstrip('#')
+        if not handle_id.isdigit():
+            self.write('Usage: %expand HANDLE_ID\n')
+            return
+        output, value = self.request('expand$%s' % handle_id)
+        self._output(output, value)
+
+    def _output(self, output, value=None):
+        """
+        write output, display value decoded from target
+        """
+        if value is not None:
+            self.write(output)
+            self.displayhook(value)
+            return
+        if not output:
             return
-        except:
-            pass
         if not output.endswith('\n\n'):
             output += '\n'
         self.displayhook.start_displayhook()
@@ -122,21 +142,106 @@ class IPythonShell(InteractiveShellEmbed):
     def runsource(self, source):
         self.write(self._runsource(source))
 
-    def _runsource(self, source, *args, **kwargs):
-        self.sock.send(source)
-        raw = self.sock.recv()
-        if raw == '' or raw is None:
+    def hello(self, compress_level=0):
+        """
+        agree on frame options with target, before any request
+        """
+        options = {'compress_level': compress_level}
+        self.sock.send_message(MSG_HELLO, 0, json.dumps(options))
+        message = self.sock.recv_message()
+        if message is None:
             exit(0)
-        flag, op = raw[0], raw[1:]
-        # TODO old interface which is not used, going to be deprecated.
-        flag == '0'
-        return op
+        accepted = json.loads(message[2])
+        self.sock.compress_level = accepted.get('compress_level', 0)
+
+    def _runsource(self, source, *args, **kwargs):
+        return self.request(source)[0]
+
+    def request(self, source):
+        """
+        Returns:
+            tuple: (output, result value or None)
+        """
+        with self.request_lock:
+            return self.wait_response(self.send_request(source))
+
+    def run_batch(self, sources):
+        """
+        send all sources before waiting, write their outputs in order
+        """
+        with self.request_lock:
+            request_ids = [self.send_request(source) for source in sources]
+            for request_id in request_ids:
+                self.write(self.wait_response(request_id)[0])
+
+    def send_request(self, source):
+        request_id = next(self.request_ids)
+        self.sock.send_message(MSG_REQUEST, request_id, source)
+        return request_id
+
+    def wait_response(self, request_id):
+        """
+        Returns:
+            tuple: (output, result value or None) of request
+        """
+        value = None
+        while True:
+            message = self.sock.recv_message()
+            if message is None:
+                exit(0)
+            msg_type, response_id, op = message
+            # left by a request interrupted before its response
+            if response_id != request_id:
+                continue
+            if msg_type == MSG_CHUNK:
+                self.write(op)
+                self.flush()
+            elif msg_type == MSG_VALUE:
+                value = values.loads(op)
+            else:
+                return op, value
+
+    def flush(self):
+        sys.stdout.flush()
 
     def remote_completer(self, ipcompleter, text, line=None, cursor_pos=None):
-        source = 'complete$%s' % text
-        op = self._runsource(source)
+        item, prefix = split_text(text)
+        trie = self.completion_trie(item)
+        if trie is None:
+            return []
+        names = trie.find(prefix)
+        if item:
+            names = [item + '.' + name for name in names]
+        return names
+
+    def completion_trie(self, item):
+        """
+        Returns:
+            PrefixTrie: names of item, fetched from target if not cached
+        """
+        trie = self.completion_tries.get(item)
+        if trie is not None:
+            return trie
+        if item not in self.completion_names:
+            self.fetch_names(item)
+        names = self.completion_names.get(item)
+        if names is None:
+            return None
+        trie = self.completion_tries[item] = PrefixTrie(names)
+        return trie
+
+    def fetch_names(self, item):
+        """fetch names of item and its children likely completed next"""
+        op = self._runsource('names$%s' % item)
         try:
-            # ignore those cases like obj not exists
-            return json.loads(op)
+            result = json.loads(op)
         except:
-            return []
+            # ignore those cases like obj not exists
+            return
+        self.completion_names[item] = result['names']
+        for child, names in result['children'].items():
+            self.completion_names.setdefault(child, names)
+
+    def clear_completions(self):
+        self.completion_names.clear()
+        self.completion_tries.clear()
@@ -1,49 +1,11 @@
 # -*- coding: utf-8 -*-
 
 
-import time
-from threading import Thread
-from .sock import SockServer
+from .server import AsyncServer
 from .inject import inject
+from .agent import connect_agent
 from .ipython_embed import IPythonShell
-
-
-class AsyncServer(object):
-    """
-    """
-    LISTEN_TIMEOUT = 30
-
-    def start_server(self, encoding, timeout):
-        """start sock server and wait for client"""
-        self.sock_server = SockServer(
-            listen_timeout=self.LISTEN_TIMEOUT,
-            transport_timeout=timeout or 0,
-            encoding=encoding)
-        self.sock_server.listen()
-        self.async_accept()
-        return (self.sock_server.host, self.sock_server.port)
-
-    def async_accept(self):
-        """start a thread to wait for sock server accept"""
-        thread = Thread(
-            target=self.sock_server.accept, name="sock_server_async_accept")
-        thread.daemon = True
-        self.async_accept_thread = thread
-        thread.start()
-
-    def wait(self):
-        """wait for remote client to connet"""
-        while self.async_accept_thread and self.async_accept_thread.is_alive():
-            time.sleep(0.1)
-        if not self.sock_server.connected():
-            raise NoConnectedClient(
-                "No client connected in %s seconds" % self.LISTEN_TIMEOUT
-            )
-        self.sock = self.sock_server
-
-
-class NoConnectedClient(Exception):
-    pass
+from .timing import Timing
 
 
 class SimpleRemoteProxy(object):
@@ -57,20 +19,32 @@ class BaseProxy(AsyncServer, SimpleRemoteProxy):
     def __init__(self, inject_args):
         """"""
         self.inject_args = inject_args
+        self.timing = Timing()
 
     def run(self):
         """"""
-        host, port = self.start_server(
+        with self.timing.step('agent'):
+            agent = connect_agent(
+                self.inject_args, self.inject_args.get('resident'))
+            if agent:
+                self.sock = agent.shell(
+                    stream=self.inject_args.get('stream'))
+        if agent:
+            return
+        address = self.start_server(
             encoding=self.inject_args.get('encoding'),
-            timeout=self.inject_args.get('timeout')
+            timeout=self.inject_args.get('timeout'),
+            pid=self.inject_args['pid']
         )
         inject(
             module=self.MODULE,
             entrance=self.ENTRANCE,
-            host=host,
-            port=port,
-            inject_args=self.inject_args)
-        self.wait()
+            inject_args=self.inject_args,
+            timing=self.timing,
+            stream=bool(self.inject_args.get('stream')),
+            **address)
+        with self.timing.step('connect'):
+            self.wait()
 
 
 class IPythonShellProxy(BaseProxy, IPythonShell):
@@ -79,3 +53,10 @@ class IPythonShellProxy(BaseProxy, IPythonShell):
     def __init__(self, inject_args):
         BaseProxy.__init__(self, inject_args)
         IPythonShell.__init__(self, inject_args.get('encode'))
+
+    def run(self):
+        """"""
+        BaseProxy.run(self)
+        # frames are plain unless compression asked and agreed
+        if self.inject_args.get('compress_level'):
+            self.hello(self.inject_args['compress_level'])
@@ -5,33 +5,150 @@ import traceback
 import threading
 import code
 import json
+import socket
 
-from pylane.shell.sock import SockClient
+from pylane.shell.sock import SockClient, UnixSockClient, Transport, \
+    MSG_RESPONSE, MSG_CHUNK, MSG_VALUE, MSG_HELLO
+from pylane.shell import values, completion
 
 if sys.version_info[0] == 3:
-    from io import StringIO
+    from queue import Queue
 else:
-    from io import BytesIO as StringIO
+    from Queue import Queue
+
+try:
+    from threading import get_ident
+except ImportError:
+    from thread import get_ident
+
+
+class ThreadRouter(object):
+    """
+    Process wide sys attribute installed once, dispatch to the target routed
+    by current thread, or to the original one
+    """
+
+    # each shell payload defines these classes again, an installed router
+    # is known by this mark instead of its class
+    _pylane_router = True
+
+    def __init__(self, default):
+        self.default = default
+        self.routes = {}
+
+    @classmethod
+    def install(cls, name):
+        router = getattr(sys, name)
+        if not getattr(router, '_pylane_router', False):
+            router = cls(router)
+            setattr(sys, name, router)
+        return router
+
+    def route(self, target):
+        """
+        Returns:
+            object: previous target of current thread, None if not routed
+        """
+        ident = get_ident()
+        previous = self.routes.get(ident)
+        if target is None:
+            self.routes.pop(ident, None)
+        else:
+            self.routes[ident] = target
+        return previous
+
+    def current(self):
+        return self.routes.get(get_ident(), self.default)
+
+
+class RoutedStream(ThreadRouter):
+    """
+    sys std stream, writes of shell threads are captured, writes of other
+    threads go to the original stream
+    """
+
+    def write(self, text):
+        return self.current().write(text)
+
+    def flush(self):
+        return self.current().flush()
+
+    def __getattr__(self, name):
+        return getattr(self.current(), name)
+
+
+class RoutedDisplayhook(ThreadRouter):
+
+    def __call__(self, value):
+        return self.current()(value)
+
+
+class BoundedOutput(object):
+    """
+    File-like string buffer, keeps at most MAX_SIZE chars, text beyond is
+    dropped and counted
+    """
+
+    MAX_SIZE = 1 << 20
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size or self.MAX_SIZE
+        self.truncate()
+
+    def write(self, text):
+        room = max(self.max_size - self.size, 0)
+        if len(text) > room:
+            self.dropped += len(text) - room
+            text = text[:room]
+        if text:
+            self.buffer.append(text)
+            self.size += len(text)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+    def getvalue(self):
+        text = ''.join(self.buffer)
+        if self.dropped:
+            text += '\n... %d chars truncated\n' % self.dropped
+        return text
+
+    def seek(self, pos):
+        pass
+
+    def truncate(self):
+        self.buffer = []
+        self.size = 0
+        self.dropped = 0
 
 
 class OutputHookContext(object):
     """
-    Hook sys std with string io
+    Capture sys std written by current thread in bounded buffers, other
+    threads of target write to sys std as usual
     """
 
-    def __enter__(self):
-        self.sys_stdout = sys.stdout
-        sys.stdout = self.stdout = StringIO()
+    def open_stdout(self):
+        return BoundedOutput()
 
-        self.sys_stderr = sys.stderr
-        sys.stderr = self.stderr = StringIO()
+    def __enter__(self):
+        self.stdout = self.open_stdout()
+        self.stderr = BoundedOutput()
+        self.routers = (
+            RoutedStream.install('stdout'), RoutedStream.install('stderr'))
+        self.previous = (
+            self.routers[0].route(self.stdout),
+            self.routers[1].route(self.stderr))
 
     def __exit__(self, *args, **kwargs):
-        sys.stdout = self.sys_stdout
-        sys.stderr = self.sys_stderr
+        for router, previous in zip(self.routers, self.previous):
+            router.route(previous)
 
     def truncate(self):
-        for io in (sys.stdout, sys.stderr):
+        for io in (self.stdout, self.stderr):
             io.seek(0)
             io.truncate()
 
@@ -44,6 +161,129 @@ class OutputHookContext(object):
         return value
 
 
+class ChunkedOutput(object):
+    """
+    File-like stdout, send written text in chunks while a command runs,
+    text spills to client once CHUNK_SIZE is buffered
+    """
+
+    CHUNK_SIZE = 8192
+
+    def __init__(self, send):
+        self.send = send
+        self.buffer = []
+        self.size = 0
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+
+    def write(self, text):
+        with self.lock:
+            self.buffer.append(text)
+            self.size += len(text)
+            full = self.size >= self.CHUNK_SIZE
+        if full:
+            self.flush()
+
+    def take(self):
+        with self.lock:
+            text = ''.join(self.buffer)
+            self.buffer = []
+            self.size = 0
+        return text
+
+    def flush(self):
+        # keep chunks in order when flushed by several threads
+        with self.flush_lock:
+            text = self.take()
+            if text:
+                self.send(text)
+
+    def getvalue(self):
+        with self.lock:
+            return ''.join(self.buffer)
+
+    def getvalue_truncate(self):
+        """take text not sent, after a flush in progress is sent"""
+        with self.flush_lock:
+            return self.take()
+
+    def seek(self, pos):
+        pass
+
+    def truncate(self):
+        self.take()
+
+
+class StreamingOutputHookContext(OutputHookContext):
+    """
+    Capture stdout in chunked output, flushed in a background thread,
+    unflushed text is left for getvalue as the final output
+    """
+
+    FLUSH_INTERVAL = 0.2
+
+    def __init__(self, send):
+        self.send = send
+
+    def open_stdout(self):
+        return ChunkedOutput(self.send)
+
+    def __enter__(self):
+        OutputHookContext.__enter__(self)
+        self.stopped = threading.Event()
+        self.flusher = threading.Thread(
+            target=self.flush_loop, name="pylane-shell-flusher")
+        self.flusher.daemon = True
+        self.flusher.start()
+
+    def __exit__(self, *args, **kwargs):
+        self.stop()
+        OutputHookContext.__exit__(self, *args, **kwargs)
+
+    def stop(self):
+        """stop flushing in background"""
+        self.stopped.set()
+        self.flusher.join()
+
+    def getvalue_truncate(self):
+        # flusher is stopped first, text is either sent in a chunk or left
+        # in the final output, never both or neither
+        self.stop()
+        out = self.stdout.getvalue_truncate()
+        err = self.stderr.getvalue()
+        self.stderr.truncate()
+        return out, err
+
+    def flush_loop(self):
+        while not self.stopped.wait(self.FLUSH_INTERVAL):
+            self.stdout.flush()
+
+
+class ValueHookContext(object):
+    """
+    Hook sys displayhook of current thread, keep value of the last
+    expression instead of printing its repr
+    """
+
+    def __init__(self, namespace):
+        self.namespace = namespace
+        self.value = None
+
+    def __enter__(self):
+        self.value = None
+        self.router = RoutedDisplayhook.install('displayhook')
+        self.previous = self.router.route(self.displayhook)
+
+    def __exit__(self, *args, **kwargs):
+        self.router.route(self.previous)
+
+    def displayhook(self, value):
+        if value is None:
+            return
+        self.value = value
+        self.namespace['_'] = value
+
+
 class RemoteShellThread(threading.Thread):
     """
     Start a thread in target process, run an interpreter
@@ -53,8 +293,14 @@ class RemoteShellThread(threading.Thread):
     port = 9594
     debug = False
 
-    def __init__(self, host=None, port=None, encoding='utf-8'):
+    # extend functions which need no std hook, run beside a running command
+    CONCURRENT_FUNCTIONS = ('help_doc', 'complete', 'names', 'expand')
+
+    def __init__(self, host=None, port=None, encoding='utf-8', sock=None,
+                 path=None, stream=False):
         """
+        connect to unix socket path or host:port, or serve on an accepted sock,
+        stream output of commands in chunks if stream
         """
         if host:
             self.host = host
@@ -62,8 +308,18 @@ class RemoteShellThread(threading.Thread):
             self.port = port
 
         self.encoding = encoding
+        # sys std is captured by thread, commands of other clients run
+        # beside, commands of this client are run one by one
         self.lock = threading.RLock()
+        self.send_lock = threading.Lock()
+        self.commands = Queue()
+        self.request_id = 0
         self.stdio_hook = OutputHookContext()
+        self.command_hook = self.stdio_hook
+        if stream:
+            self.command_hook = StreamingOutputHookContext(self.send_chunk)
+        # hook which get_output reads from
+        self.output_hook = self.stdio_hook
 
         import __main__ as main
         self.user_defined_executor = getattr(
@@ -72,28 +328,132 @@ class RemoteShellThread(threading.Thread):
         self.user_defined_executor_local = {}
 
         self._interpreter = code.InteractiveInterpreter(locals=locals())
+        self.value_hook = ValueHookContext(self._interpreter.locals)
+        self.handles = values.HandleTable()
+        self.completions = completion.CompletionCache()
         self.runsource('import sys')
         self.runsource('import __main__ as main')
 
-        self.sock = SockClient(self.host, self.port, encoding)
+        if sock:
+            self.sock = Transport(sock, encoding)
+        elif path:
+            self.sock = UnixSockClient(path, encoding)
+        else:
+            self.sock = SockClient(self.host, self.port, encoding)
         super(RemoteShellThread, self).__init__()
 
     def handle(self):
         """
-        handle io
+        handle io, commands are run in order by a worker thread,
+        concurrent requests are run in their own threads
+        """
+        worker = threading.Thread(
+            target=self.run_commands, name="pylane-shell-worker")
+        worker.daemon = True
+        worker.start()
+        try:
+            while True:
+                message = self.sock.recv_message()
+                if message is None:
+                    break
+                msg_type, request_id, source = message
+                if msg_type == MSG_HELLO:
+                    self.hello(source)
+                elif self.is_concurrent(source):
+                    thread = threading.Thread(
+                        target=self.serve, args=(request_id, source))
+                    thread.daemon = True
+                    thread.start()
+                else:
+                    self.commands.put((request_id, source))
+        finally:
+            self.commands.put(None)
+
+    def hello(self, options):
+        """
+        agree on frame options asked by client, reply accepted options
         """
-        while True:
-            cmd = self.sock.recv()
-            # recv of sock closed returns '' in py2 and None in py3
-            if cmd == '' or cmd is None:
-                break
-            flag = '0'
-            self.sock.send(flag + self.runsource(cmd))
+        options = json.loads(options)
+        level = min(max(int(options.get('compress_level', 0)), 0), 9)
+        with self.send_lock:
+            self.sock.send_message(
+                MSG_HELLO, 0, json.dumps({'compress_level': level}))
+            self.sock.compress_level = level
+
+    def run_commands(self):
+        try:
+            while True:
+                command = self.commands.get()
+                if command is None:
+                    break
+                self.request_id = command[0]
+                self.serve(*command)
+        except SystemExit:
+            # exit() in a command ends the shell, wake io thread and client
+            try:
+                self.sock.sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def serve(self, request_id, source):
+        try:
+            output, value = self.run_request(source)
+        except Exception:
+            # e.g. raised by user defined executor, the worker goes on
+            output, value = traceback.format_exc(), None
+        try:
+            if value is not None:
+                self.send_value(request_id, value)
+            self.send(MSG_RESPONSE, request_id, output)
+        except socket.error:
+            # client gone while running
+            pass
+
+    def send(self, msg_type, request_id, data):
+        with self.send_lock:
+            self.sock.send_message(msg_type, request_id, data)
+
+    def send_value(self, request_id, value):
+        with self.send_lock:
+            self.sock.send_bytes(value, MSG_VALUE, request_id)
+
+    def send_chunk(self, data):
+        self.send(MSG_CHUNK, self.request_id, data)
+
+    def is_concurrent(self, source):
+        if self.in_user_defined_executor:
+            return False
+        return self.get_extend_name(source.strip()) in \
+            self.CONCURRENT_FUNCTIONS
 
     def runsource(self, source, filename="<input>", symbol="single"):
         """
         run code in interpreter
         """
+        return self.run_request(source)[0]
+
+    def run_request(self, source):
+        """
+        run a request
+        Returns:
+            tuple: (output, marshal data of result value or None)
+        """
+        if self.is_concurrent(source):
+            name = self.get_extend_name(source.strip())
+            try:
+                if name == 'expand':
+                    return self.expand(source.strip())
+                return self.extend_functions[name](self, source.strip()), None
+            except Exception as e:
+                return "Failed to run source %s err: %s" % (source, e), None
+
+        output = self.run_command(source)
+        if self.value_hook.value is None:
+            return output, None
+        value, self.value_hook.value = self.value_hook.value, None
+        return output, values.dumps(value, self.handles)
+
+    def run_command(self, source):
         with self.lock:
             source_strip = source.strip()
             if source_strip == '$enter_executor':
@@ -108,10 +468,11 @@ class RemoteShellThread(threading.Thread):
 
             if self.in_user_defined_executor and self.user_defined_executor:
                 with self.stdio_hook:
-                    return repr(self.user_defined_executor(
+                    self.value_hook.value = self.user_defined_executor(
                         source_strip,
                         self.user_defined_executor_local
-                    ))
+                    )
+                    return ''
 
             extend_function = self.get_extend_function(source_strip)
             if extend_function:
@@ -121,16 +482,20 @@ class RemoteShellThread(threading.Thread):
                     except Exception as e:
                         print("Failed to run source", source, "err:", e)
 
-            with self.stdio_hook:
-                state, op = self._runsource(source)
-                if not state:
-                    print("Failed to run source", source)
-                return op
+            self.output_hook = self.command_hook
+            try:
+                with self.command_hook, self.value_hook:
+                    state, op = self._runsource(source)
+                    if not state:
+                        print("Failed to run source", source)
+                    return op
+            finally:
+                self.output_hook = self.stdio_hook
 
     def get_output(self):
         """
         """
-        out, err = self.stdio_hook.getvalue_truncate()
+        out, err = self.output_hook.getvalue_truncate()
         try:
             out = out.decode(self.encoding)
             err = err.decode(self.encoding)
@@ -155,56 +520,79 @@ class RemoteShellThread(threading.Thread):
                 source, ret))
         return ret
 
+    def expand(self, source):
+        """
+        expand$handle_id, encode all items or attributes of a handle
+        """
+        handle_id = int(source.split('$', 1)[1])
+        try:
+            obj = self.handles.get(handle_id)
+        except KeyError:
+            return 'Handle #%d is dropped, run the command again.' % (
+                handle_id), None
+        return '', values.dumps(obj, self.handles, expanded=True)
+
+    def eval_source(self, source):
+        """
+        eval an expression in interpreter namespace, no std hooked,
+        safe to run beside a running command
+        """
+        return eval(source, self._interpreter.locals)
+
     def run_help_doc(self, source):
         """
         support object?
         TODO more info when object??
         """
         item = source.replace('??', '').replace('?', '')
-        state, doc = self._runsource('%s.__doc__' % item)
-        if not state:
-            return doc
-        state, type_ = self._runsource('type(%s).__name__' % item)
-        state, type_ = self._runsource('type(%s).__name__' % item)
-        if not state:
-            return type_
-        op = "Type: %sDocstring: %s" % (type_, doc)
-        return op
+        try:
+            obj = self.eval_source(item)
+        except Exception as e:
+            return ''.join(traceback.format_exception_only(type(e), e))
+        return "Type: %s\nDocstring: %s\n" % (type(obj).__name__, obj.__doc__)
 
     def complete(self, source):
         """
+        complete$text, names starting with text
         """
         text = source.split('$', 2)[1]
-        suggs = []
-        # for obj.\t
-        if text.endswith('.'):
-            item = text[:-1]
-            state, op = self._runsource('dir(%s)' % item)
-            if not state:
-                return op
-            dir_list = eval(op)
-            suggs = [item + '.' + t for t in dir_list]
-        # for obj.prefix\t
-        elif '.' in text:
-            item, sub_text = text.rsplit('.', 1)
-            state, op = self._runsource('dir(%s)' % item)
-            if not state:
-                return op
-            dir_list = eval(op)
-            for t in dir_list:
-                if t.startswith(sub_text):
-                    suggs.append(item + '.' + t)
-        # for prefix\t
-        else:
-            state, op = self._runsource('dir()')
-            if not state:
-                return op
-            dir_list = eval(op)
-            for t in dir_list:
-                if t.startswith(text):
-                    suggs.append(t)
+        item, prefix = completion.split_text(text)
+        names = completion.startswith(self.complete_dir(item), prefix)
+        if item:
+            names = [item + '.' + name for name in names]
+        return json.dumps(names)
 
-        return json.dumps(suggs)
+    def list_names(self, source):
+        """
+        names$item, all names of item for client to cache, with names of
+        children prefetched in background since last names request
+        """
+        item = source.split('$', 2)[1]
+        names = self.complete_dir(item)
+        if names:
+            if item:
+                obj = self.eval_source(item)
+                get = lambda name: completion.static_getattr(obj, name)
+            else:
+                get = self._interpreter.locals.__getitem__
+            self.completions.prefetch(item, names, get)
+        return json.dumps({
+            'names': names,
+            'children': self.completions.take_prefetched(),
+        })
+
+    def complete_dir(self, item=''):
+        """
+        Returns:
+            list: sorted attribute names of item or names in namespace,
+                empty if item not exists
+        """
+        try:
+            if not item:
+                return self.completions.namespace(self._interpreter.locals)
+            return self.completions.names(item, self.eval_source(item))
+        except Exception:
+            return []
 
     def user_defined_function(self, source):
         import __main__ as main
@@ -221,18 +609,20 @@ class RemoteShellThread(threading.Thread):
     def get_extend_function(self, source):
         """
         """
+        return self.extend_functions.get(self.get_extend_name(source))
+
+    def get_extend_name(self, source):
         if source.endswith('?'):
-            return self.extend_functions['help_doc']
+            return 'help_doc'
         if source.startswith('$'):
-            return self.extend_functions['udf']
-        return self.extend_functions.get(
-            source.split('$')[0]
-        )
+            return 'udf'
+        return source.split('$')[0]
 
     extend_functions = {
         'help_doc': run_help_doc,
         'udf': user_defined_function,
-        'complete': complete
+        'complete': complete,
+        'names': list_names,
     }
 
     def run(self):
@@ -241,7 +631,8 @@ class RemoteShellThread(threading.Thread):
         """
         self.name = "pylane-shell-thread"
         try:
-            self.sock.connect()
+            if self.sock.sock is None:
+                self.sock.connect()
             self.handle()
         except SystemExit:
             pass
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import stat
+import json
+import time
+import socket
+import weakref
+import threading
+import traceback
+
+from pylane.shell.sock import Transport
+from pylane.shell.remote_shell import RemoteShellThread
+from pylane.shell.exec_runner import ExecRunnerThread
+
+
+# per uid, only its owner can enter
+AGENT_DIR = '/tmp/pylane-agent-%s'
+
+
+class ResidentAgentThread(threading.Thread):
+    """
+    Stay in target process, listen on a per-pid unix socket,
+    serve shell and inject requests without another injection.
+    """
+
+    def __init__(self, encoding='utf-8'):
+        """
+        """
+        self.encoding = encoding
+        self.dir = AGENT_DIR % os.getuid()
+        self.path = os.path.join(self.dir, '%s.sock' % os.getpid())
+        self.started = time.time()
+        self.server = None
+        # connections accepted, shells and runners close their own
+        self.clients = weakref.WeakSet()
+        self.running = True
+        super(ResidentAgentThread, self).__init__()
+        self.daemon = True
+        self.name = "pylane-agent-thread"
+
+    def listen(self):
+        """
+        bind the per-pid unix socket in a private dir, only owner can connect
+        """
+        if not os.path.lexists(self.dir):
+            os.mkdir(self.dir, 0o700)
+        # another user may create it first or swap in a symlink
+        st = os.lstat(self.dir)
+        if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or \
+                st.st_mode & 0o077:
+            raise OSError('agent dir %s is not a private dir of ours'
+                          % self.dir)
+        if os.path.lexists(self.path):
+            os.remove(self.path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.path)
+        os.chmod(self.path, 0o600)
+        server.listen(8)
+        self.server = server
+
+    def info(self):
+        return {
+            'pid': os.getpid(),
+            'started': self.started,
+            'executable': sys.executable,
+            'kind': 'thread',
+        }
+
+    def handle(self, sock):
+        """
+        handle one request, shell request keeps sock
+        """
+        transport = Transport(sock, self.encoding)
+        cmd = transport.recv()
+        if cmd == 'ping':
+            transport.send(json.dumps(self.info()))
+        elif cmd == 'shell':
+            options = json.loads(transport.recv() or '{}')
+            RemoteShellThread(encoding=self.encoding, sock=sock,
+                              stream=options.get('stream', False)).start()
+            return
+        elif cmd == 'exec':
+            ExecRunnerThread(encoding=self.encoding, sock=sock).start()
+            return
+        elif cmd == 'inject':
+            code = transport.recv()
+            thread = threading.Thread(target=self.exec_code, args=(code,))
+            thread.daemon = True
+            thread.start()
+            transport.send('ok')
+        elif cmd == 'unload':
+            self.running = False
+            transport.send('ok')
+            self.stop()
+        transport.close()
+
+    def stop(self):
+        """
+        end client connections first, then wake up accept of main loop,
+        either may be closed already by its owner
+        """
+        for sock in list(self.clients) + [self.server]:
+            try:
+                sock and sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def serve(self, sock):
+        try:
+            self.handle(sock)
+        except:
+            traceback.print_exc(file=sys.__stderr__)
+
+    def exec_code(self, code):
+        try:
+            exec(code, {'__name__': '__pylane_inject__'})
+        except:
+            traceback.print_exc(file=sys.__stderr__)
+
+    def unload(self):
+        try:
+            self.server and self.server.close()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+        except:
+            traceback.print_exc(file=sys.__stderr__)
+
+    def run(self):
+        """
+        main run entrance
+        """
+        try:
+            self.listen()
+            while self.running:
+                try:
+                    (sock, _) = self.server.accept()
+                except socket.error:
+                    if self.running:
+                        raise
+                    break
+                self.clients.add(sock)
+                # a slow client never blocks others
+                thread = threading.Thread(target=self.serve, args=(sock,))
+                thread.daemon = True
+                thread.start()
+        except:
+            traceback.print_exc(file=sys.__stderr__)
+        finally:
+            self.unload()
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+
+from threading import Thread
+from .sock import SockServer, UnixSockServer
+
+
+class AsyncServer(object):
+    """
+    """
+    LISTEN_TIMEOUT = 30
+
+    def start_server(self, encoding, timeout, pid=None):
+        """start sock server and wait for client
+        Returns:
+            dict: address args for target to connect, path or host and port
+        """
+        if pid and UnixSockServer.available(pid):
+            self.sock_server = UnixSockServer(
+                pid,
+                listen_timeout=self.LISTEN_TIMEOUT,
+                transport_timeout=timeout or 0,
+                encoding=encoding)
+            self.sock_server.listen()
+            self.async_accept()
+            return {'path': self.sock_server.path}
+        self.sock_server = SockServer(
+            listen_timeout=self.LISTEN_TIMEOUT,
+            transport_timeout=timeout or 0,
+            encoding=encoding)
+        self.sock_server.listen()
+        self.async_accept()
+        return {'host': self.sock_server.host, 'port': self.sock_server.port}
+
+    def async_accept(self):
+        """start a thread to wait for sock server accept"""
+        thread = Thread(
+            target=self.sock_server.accept, name="sock_server_async_accept")
+        thread.daemon = True
+        self.async_accept_thread = thread
+        thread.start()
+
+    def wait(self):
+        """wait for remote client to connet"""
+        # accept thread ends once connected or listen timeout
+        if self.async_accept_thread:
+            self.async_accept_thread.join()
+        if not self.sock_server.connected():
+            raise NoConnectedClient(
+                "No client connected in %s seconds" % self.LISTEN_TIMEOUT
+            )
+        self.sock = self.sock_server
+
+
+class NoConnectedClient(Exception):
+    pass
@@ -34,6 +34,11 @@ class Shell(object):
     Use 'main' to access remote process's __main__ object.
     Use 'tools' to get pylane toolkit functions.
         Example: tools.get_insts(YOUR_CLASS_NAME).
+        Repeated lookups on a large heap: snap = tools.snapshot(),
+            then snap.insts(YOUR_CLASS_NAME), snap.top(), snap.refresh().
+        What is growing: a = tools.heap_histogram(), later tools.heap_diff(a).
+        What keeps it alive: tools.print_retention_path(an_object).
+        How big it really is: tools.deep_sizeof(an_object, sample=1000).
     Use 'a_object?' for more usage info.
     """
     udf_help = """
@@ -62,10 +67,13 @@ class Shell(object):
         """run shell server and connect"""
         shell_proxy = ShellProxy(self.inject_args)
         shell_proxy.run()
-        shell_proxy.runsource("print('''%s''')" % self.extend_help)
-        for pre_code in self.pre_codes:
-            code = self.raw_code(pre_code)
-            shell_proxy.runsource(code)
+        # one round trip for all of them
+        with shell_proxy.timing.step('bootstrap'):
+            shell_proxy.run_batch(
+                ["print('''%s''')" % self.extend_help] +
+                [self.raw_code(pre_code) for pre_code in self.pre_codes])
+        if self.inject_args.get('timing'):
+            print(shell_proxy.timing.report())
         shell_proxy.interact()
 
     def raw_code(self, code):
@@ -1,11 +1,42 @@
 # -*- coding: utf-8 -*-
 
 
+import os
+import sys
 import socket
 import struct
 import traceback
 import random
 import time
+import zlib
+
+
+# frame header: length of data, message type, flags and request id
+HEADER = struct.Struct('<LBBL')
+
+# plain data out of any request, used by one-shot protocols
+MSG_DATA = 0
+MSG_REQUEST = 1
+MSG_RESPONSE = 2
+# partial output of a request, sent before its response
+MSG_CHUNK = 3
+# marshal data of the result value of a request, sent before its response
+MSG_VALUE = 4
+# frame options agreed by both ends at connect time
+MSG_HELLO = 5
+# messages of bytes, not decoded
+BINARY_MESSAGES = (MSG_VALUE,)
+
+# frame flags
+FLAG_ZLIB = 1
+
+
+def peer_pid(sock):
+    """pid of the process on the other end of a unix sock"""
+    cred = sock.getsockopt(
+        socket.SOL_SOCKET, getattr(socket, 'SO_PEERCRED', 17),
+        struct.calcsize('3i'))
+    return struct.unpack('3i', cred)[0]
 
 
 class Transport(object):
@@ -14,39 +45,125 @@ class Transport(object):
 
     sock = None
     encoding = 'utf-8'
+    # zlib level of sent frames, 0 means no compression, set after
+    # negotiated, compressed frames are always accepted
+    compress_level = 0
+    # smaller frames are not worth compressing
+    COMPRESS_THRESHOLD = 4096
+
+    def __init__(self, sock=None, encoding='utf-8'):
+        """
+        wrap a connected sock
+        """
+        self.sock = sock
+        self.encoding = encoding
 
     def send(self, data):
         """
-        send data with length in 4 bytes header
+        send data in a plain data frame
+        """
+        self.send_bytes(data.encode(self.encoding))
+
+    def send_message(self, msg_type, request_id, data):
+        """
+        send data in a frame of message type and request id
+        """
+        self.send_bytes(data.encode(self.encoding), msg_type, request_id)
+
+    def send_bytes(self, data, msg_type=MSG_DATA, request_id=0, flags=0):
+        """
+        send bytes with frame header
+        """
+        if self.compress_level and len(data) >= self.COMPRESS_THRESHOLD:
+            compressed = zlib.compress(data, self.compress_level)
+            if len(compressed) < len(data):
+                data = compressed
+                flags |= FLAG_ZLIB
+        header = HEADER.pack(len(data), msg_type, flags, request_id)
+        self.sendv(header, data)
+
+    def sendv(self, *buffers):
+        """
+        scatter-gather send buffers without joining them
         """
-        data = data.encode(self.encoding)
-        header = struct.pack('<L', len(data))
-        self.sock.sendall(header + data)
+        sendmsg = getattr(self.sock, 'sendmsg', None)
+        if sendmsg is None:
+            # py2 has no sendmsg, one sendall avoids nagle delay
+            self.sock.sendall(b''.join(buffers))
+            return
+        views = [memoryview(buf) for buf in buffers]
+        while views:
+            sent = sendmsg(views)
+            while views and sent >= len(views[0]):
+                sent -= len(views[0])
+                views.pop(0)
+            if sent:
+                views[0] = views[0][sent:]
 
     def recv(self):
         """
         recv data
         """
-        header = self.recv_bytes(4)
+        data = self.recv_frame()
+        if data is None or data == '':
+            return data
+        return data.decode(self.encoding)
+
+    def recv_message(self):
+        """
+        recv a message
+        Returns:
+            tuple: (msg_type, request_id, data), None if sock closed
+        """
+        frame = self.recv_raw_frame()
+        if frame is None or frame == '':
+            return None
+        msg_type, _, request_id, data = frame
+        if msg_type not in BINARY_MESSAGES:
+            data = data.decode(self.encoding)
+        return msg_type, request_id, data
+
+    def recv_frame(self):
+        """
+        recv a frame, returns bytes-like data
+        """
+        frame = self.recv_raw_frame()
+        if frame is None or frame == '':
+            return frame
+        return frame[3]
+
+    def recv_raw_frame(self):
+        """
+        recv a frame
+        Returns:
+            tuple: (msg_type, flags, request_id, bytes-like data)
+        """
+        header = self.recv_bytes(HEADER.size)
         if header == '':
             return header
         try:
-            length = struct.unpack('<L', header)[0]
+            length, msg_type, flags, request_id = HEADER.unpack(header)
         except:
             return None
-        data = self.recv_bytes(length).decode(self.encoding)
-        return data
+        data = self.recv_bytes(length)
+        if flags & FLAG_ZLIB:
+            data = zlib.decompress(bytes(data))
+        return msg_type, flags, request_id, data
 
     def recv_bytes(self, n):
         """
-        recv n bytes
+        recv n bytes into a preallocated buffer
         """
-        data = b''
-        while len(data) < n:
-            chunk = self.sock.recv(n - len(data))
-            if not chunk:
+        data = bytearray(n)
+        view = memoryview(data)
+        received = 0
+        while received < n:
+            size = self.sock.recv_into(view[received:], n - received)
+            if not size:
+                del view
+                del data[received:]
                 break
-            data += chunk
+            received += size
         return data
 
     def close(self):
@@ -61,30 +178,50 @@ class SockClient(Transport):
     """
 
     sock = None
-    CONNECT_RETRIES = 3
-    CONNECT_RETRY_INTERVAL = 1
+    family = socket.AF_INET
+    CONNECT_RETRIES = 5
+    # doubled after each retry, server listens before target is injected,
+    # so the first connect usually succeeds
+    CONNECT_RETRY_INTERVAL = 0.01
 
     def __init__(self, host, port, encoding='utf-8'):
         self.host = host
         self.port = port
+        self.address = (host, port)
         self.encoding = encoding
 
     def connect(self):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        e = None
+        interval = self.CONNECT_RETRY_INTERVAL
+        error = None
         for i in range(self.CONNECT_RETRIES):
+            sock = socket.socket(self.family, socket.SOCK_STREAM)
             try:
-                sock.connect((self.host, self.port))
+                sock.connect(self.address)
                 break
             except socket.error as e:
-                pass
-            time.sleep(self.CONNECT_RETRY_INTERVAL)
+                sock.close()
+                error = e
+            if i < self.CONNECT_RETRIES - 1:
+                time.sleep(interval)
+                interval *= 2
         else:
-            if e:
-                raise e
+            raise error
         self.sock = sock
 
 
+class UnixSockClient(SockClient):
+    """
+    """
+
+    family = getattr(socket, 'AF_UNIX', None)
+
+    def __init__(self, path, encoding='utf-8', retries=None):
+        self.path = self.address = path
+        self.encoding = encoding
+        if retries:
+            self.CONNECT_RETRIES = retries
+
+
 class SockServer(Transport):
     """
     """
@@ -155,6 +292,103 @@ class SockServer(Transport):
             traceback.print_exc()
 
 
+class UnixSockServer(SockServer):
+    """
+    Listen on an unix socket reachable by target process, abstract socket
+    if target shares our network namespace, or a socket file created in
+    target's root by /proc/PID/root, only target itself can be accepted.
+    """
+
+    SOCK_NAME = 'pylane-%s-%s'
+
+    path = None
+    bind_path = None
+
+    def __init__(self, pid, listen_timeout=30, transport_timeout=0,
+                 encoding='utf-8'):
+        """
+        """
+        SockServer.__init__(self, listen_timeout, transport_timeout, encoding)
+        self.pid = pid
+
+    @classmethod
+    def available(cls, pid):
+        return bool(cls.choose_address(pid))
+
+    @classmethod
+    def choose_address(cls, pid):
+        """
+        Returns:
+            tuple: (path for target, path for bind), None if unavailable
+        """
+        if not sys.platform.startswith('linux'):
+            return None
+        name = cls.SOCK_NAME % (os.getpid(), random.randint(0, 1 << 30))
+        try:
+            same_net = os.readlink('/proc/%d/ns/net' % pid) == \
+                os.readlink('/proc/self/ns/net')
+        except OSError:
+            same_net = False
+        if same_net:
+            address = '\0' + name
+            return address, address
+        tmp = '/proc/%d/root/tmp' % pid
+        if os.access(tmp, os.W_OK):
+            return '/tmp/%s.sock' % name, '%s/%s.sock' % (tmp, name)
+        return None
+
+    def listen(self):
+        """
+        bind and listen
+        """
+        address = self.choose_address(self.pid)
+        if not address:
+            raise NoPortAvailable('no unix socket reachable by target')
+        self.path, bind_path = address
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(bind_path)
+        if not bind_path.startswith('\0'):
+            self.bind_path = bind_path
+            # target may run as another user, peer is checked in accept
+            os.chmod(bind_path, 0o666)
+        sock.settimeout(self.listen_timeout)
+        sock.listen(self.ACCEPT_CLIENT_NUM)
+        self.server = sock
+
+    def accept(self):
+        """
+        accept target, reject other processes
+        """
+        deadline = time.time() + self.listen_timeout
+        while time.time() < deadline:
+            try:
+                (sock, _) = self.server.accept()
+            except socket.timeout:
+                return
+            if peer_pid(sock) != self.pid:
+                sock.close()
+                continue
+            if self.transport_timeout:
+                sock.settimeout(self.transport_timeout)
+            else:
+                sock.settimeout(None)
+            self.sock = self.client = sock
+            break
+        self.remove_bind_path()
+
+    def remove_bind_path(self):
+        if self.bind_path:
+            try:
+                os.remove(self.bind_path)
+            except OSError:
+                pass
+            self.bind_path = None
+
+    def close(self):
+        SockServer.close(self)
+        self.remove_bind_path()
+
+
 class NoPortAvailable(Exception):
     pass
 
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+
+import time
+from contextlib import contextmanager
+
+
+class Timing(object):
+    """
+    Durations of named steps, in order
+    """
+
+    def __init__(self):
+        self.steps = []
+
+    @contextmanager
+    def step(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.steps.append((name, time.time() - start))
+
+    def report(self):
+        total = sum(duration for _, duration in self.steps)
+        return ', '.join(
+            ['%s %.3fs' % step for step in self.steps] +
+            ['total %.3fs' % total])
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+
+"""
+Encode values of remote shell into marshal data, objects which can not be
+marshaled or too large to show are left in target as handles, decoded into
+RemoteHandle by client, and expanded on demand.
+"""
+
+import sys
+import marshal
+from collections import OrderedDict
+
+if sys.version_info[0] == 3:
+    import reprlib
+    PRIMITIVES = (type(None), bool, int, float, complex, str, bytes)
+else:
+    import repr as reprlib
+    PRIMITIVES = (type(None), bool, int, long, float, complex, str, unicode)
+
+
+# readable by both py2 and py3
+MARSHAL_VERSION = 2
+HANDLE_MARK = '\0pylane-handle'
+CONTAINERS = (list, tuple, set, frozenset, dict)
+# containers larger or deeper are left as handles
+MAX_ITEMS = 100
+MAX_DEPTH = 3
+# repr of handles, full unless too long, items beyond are left to expand
+PREVIEW_SIZE = 1 << 16
+PREVIEW_ITEMS = MAX_ITEMS * 10
+
+
+class HandleTable(object):
+    """
+    Objects left in target, referred by handle id, oldest are dropped
+    """
+
+    SIZE = 1000
+
+    def __init__(self, size=None):
+        self.size = size or self.SIZE
+        self.objects = OrderedDict()
+        self.next_id = 1
+
+    def add(self, obj):
+        handle_id = self.next_id
+        self.next_id += 1
+        self.objects[handle_id] = obj
+        while len(self.objects) > self.size:
+            self.objects.popitem(last=False)
+        return handle_id
+
+    def get(self, handle_id):
+        """raise KeyError if handle dropped"""
+        return self.objects[handle_id]
+
+
+def preview(obj):
+    previewer = reprlib.Repr()
+    for name in ('maxtuple', 'maxlist', 'maxarray', 'maxdict', 'maxset',
+                 'maxfrozenset', 'maxdeque'):
+        setattr(previewer, name, PREVIEW_ITEMS)
+    previewer.maxstring = previewer.maxlong = previewer.maxother = \
+        PREVIEW_SIZE
+    try:
+        return previewer.repr(obj)[:PREVIEW_SIZE]
+    except Exception as e:
+        return '<repr failed: %r>' % e
+
+
+def make_handle(obj, handles):
+    try:
+        length = len(obj)
+    except Exception:
+        length = -1
+    return (HANDLE_MARK, handles.add(obj), type(obj).__name__, length,
+            preview(obj))
+
+
+def encode(obj, handles, depth=0, max_items=MAX_ITEMS):
+    """
+    Returns:
+        marshal-able data of obj, handles for parts not encoded
+    """
+    obj_type = type(obj)
+    if obj_type in PRIMITIVES:
+        if obj_type is bytes and bytes is str:
+            # str of py2, shown as text
+            try:
+                return obj.decode('utf-8')
+            except UnicodeDecodeError:
+                pass
+        return obj
+    if obj_type not in CONTAINERS or depth >= MAX_DEPTH or (
+            max_items is not None and len(obj) > max_items):
+        return make_handle(obj, handles)
+    if obj_type is dict:
+        if not all(type(key) in PRIMITIVES for key in obj):
+            return make_handle(obj, handles)
+        return dict(
+            (key, encode(value, handles, depth + 1))
+            for key, value in obj.items())
+    items = [encode(item, handles, depth + 1) for item in obj]
+    if obj_type is list:
+        return items
+    try:
+        return obj_type(items)
+    except TypeError:
+        # unhashable handle data in a set
+        return make_handle(obj, handles)
+
+
+def expand(obj, handles):
+    """
+    encode all items of a container, attributes of an object
+    """
+    if type(obj) not in CONTAINERS and hasattr(obj, '__dict__'):
+        obj = dict(vars(obj), __type__=type(obj).__name__)
+    return encode(obj, handles, max_items=None)
+
+
+def dumps(obj, handles, expanded=False):
+    """
+    Returns:
+        bytes: marshal data of obj, obj itself as a handle if failed
+    """
+    try:
+        data = expand(obj, handles) if expanded else encode(obj, handles)
+        return marshal.dumps(data, MARSHAL_VERSION)
+    except (ValueError, RuntimeError):
+        return marshal.dumps(make_handle(obj, handles), MARSHAL_VERSION)
+
+
+class RemoteHandle(object):
+    """
+    Object left in target, use %expand to fetch it
+    """
+
+    def __init__(self, handle_id, type_name, length, preview):
+        self.handle_id = handle_id
+        self.type_name = type_name
+        self.length = length
+        self.preview = preview
+
+    def __repr__(self):
+        size = ' len=%d' % self.length if self.length >= 0 else ''
+        return '<%s #%d%s: %s>' % (
+            self.type_name, self.handle_id, size, self.preview)
+
+
+def decode(data):
+    """
+    Returns:
+        value with handles decoded into RemoteHandle
+    """
+    data_type = type(data)
+    if data_type is tuple and len(data) == 5 and data[0] == HANDLE_MARK:
+        return RemoteHandle(*data[1:])
+    if data_type is dict:
+        return dict((key, decode(value)) for key, value in data.items())
+    if data_type in CONTAINERS:
+        items = [decode(item) for item in data]
+        return items if data_type is list else data_type(items)
+    return data
+
+
+def loads(raw):
+    return decode(marshal.loads(bytes(raw)))